@@ -29,3 +29,12 @@ MSG_APP_FRAMERATE = 1006
 
 INPUT_ABSOLUTE = 1
 INPUT_RELATIVE = 2
+
+# Contexts of MSG_APP_FRAMERATE. Apps ask for a framerate with
+# FRAMERATE_REQUEST and the governor sets it with FRAMERATE_SET
+FRAMERATE_REQUEST = 'request'
+FRAMERATE_SET = 'set'
+
+# Contexts of MSG_SYS_BATTERY
+BATT_CAPACITY = 'capacity'
+BATT_STATUS = 'status'
@@ -1,7 +1,8 @@
-import random
-import math
 import pygame
+import numpy
 from pgwindow import FrameClock, PygameApp
+from fonts import Fonts
+from config import Config
 
 AppInfo = {'iconname':'Stars',
            'icon':'stars.png',
@@ -10,49 +11,76 @@ AppInfo = {'iconname':'Stars',
            'framerate':100}
 
 class StarsApp(PygameApp):
-    def __init__(self, wndrect, screen):
+    RADIUS = 3
+    def __init__(self, wndrect, screen, numstars=None):
         PygameApp.__init__(self, wndrect, screen)
         screenrect = screen.get_rect()
         self._origin = [screenrect.centerx, screenrect.centery]
-        self.NUMSTARS = 150
-        random.seed()
-        self.stars = []
+        if numstars is None:
+            numstars = 150
+            config = Config.section('Stars')
+            if config is not None:
+                numstars = config.getint('stars', numstars)
+        self.NUMSTARS = numstars
+        self._random = numpy.random.default_rng()
+        # Star positions and velocities, one row per star
+        self.pos = numpy.zeros((self.NUMSTARS, 2))
+        self.vel = numpy.zeros((self.NUMSTARS, 2))
         self.initialize_stars()
         self.white = 255,240,200
         self.black = 20,20,40
 
-        self._font = pygame.font.Font(None, 24)
+        # Pixel offsets making up a star
+        r = StarsApp.RADIUS
+        self._disc = [(x,y) for x in range(-r, r+1) for y in range(-r, r+1) if x*x + y*y <= r*r]
+        # Image of a star for surfaces which can't be drawn with surfarray
+        self._starimg = pygame.Surface((r*2+1, r*2+1))
+        self._starimg.fill(self.black)
+        self._starimg.set_colorkey(self.black)
+        pygame.draw.circle(self._starimg, self.white, (r, r), r, 0)
+
+        self._font = Fonts.get(None, 24)
         self._displayclock = pygame.time.Clock()
 
         self._fclock = FrameClock()
         self._fclock.ontick(15)
 
-    def init_star(self):
+    def init_stars(self, count):
         "creates new star values"
-        dir = random.randrange(100000)
-        velmult = random.random()*.6+.4
-        vel = [math.sin(dir) * velmult, math.cos(dir) * velmult]
-        return vel, self._origin[:]
+        dir = self._random.integers(100000, size=count)
+        velmult = self._random.random(count)*.6+.4
+        vel = numpy.column_stack((numpy.sin(dir), numpy.cos(dir))) * velmult[:,None]
+        pos = numpy.empty((count, 2))
+        pos[:] = self._origin
+        return vel, pos
 
     def initialize_stars(self):
         "creates a new starfield"
-        self.stars = []
-        for x in range(self.NUMSTARS):
-            star = self.init_star()
-            vel, pos = star
-            steps = random.randint(1, int(self._origin[0]))
-            pos[0] = pos[0] + (vel[0] * steps)
-            pos[1] = pos[1] + (vel[1] * steps)
-            vel[0] = vel[0] * (steps * .09)
-            vel[1] = vel[1] * (steps * .09)
-            self.stars.append(star)
+        self.vel, self.pos = self.init_stars(self.NUMSTARS)
+        steps = self._random.integers(1, int(self._origin[0])+1, size=self.NUMSTARS)[:,None]
+        self.pos += self.vel * steps
+        self.vel *= steps * .09
         self.move_stars()
-  
+
     def draw_stars(self,color):
         "used to draw the stars"
-        for vel, pos in self.stars:
-            pos = (int(pos[0]), int(pos[1]))
-            pygame.draw.circle(self._surface,color,pos,3,0)
+        xy = self.pos.astype(int)
+        try:
+            pixels = pygame.surfarray.pixels2d(self._surface)
+        except ValueError:
+            # 24 bit surfaces have no 2D pixel array. Blit an image of each star
+            r = StarsApp.RADIUS
+            self._surface.blits([(self._starimg, (x-r, y-r)) for x, y in xy], False)
+        else:
+            w, h = pixels.shape
+            value = self._surface.map_rgb(color)
+            for dx, dy in self._disc:
+                x = xy[:,0] + dx
+                y = xy[:,1] + dy
+                inside = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+                pixels[x[inside], y[inside]] = value
+            # Unlock the surface
+            del pixels
         # Display FPS
         txt = self._font.render("FPS {}".format(int(self._displayclock.get_fps())), 1, self.white)
         self._surface.blit(txt, txt.get_rect(top=0,right=self._wndpos.width))
@@ -60,23 +88,65 @@ class StarsApp(PygameApp):
 
     def move_stars(self):
         "animate the star values"
-        for vel, pos in self.stars:
-            pos[0] = pos[0] + vel[0]
-            pos[1] = pos[1] + vel[1]
-            if not 0 <= pos[0] <= self._wndpos.width or not 0 <= pos[1] <= self._wndpos.height:
-                vel[:], pos[:] = self.init_star()
-            else:
-                vel[0] = vel[0] * 1.05
-                vel[1] = vel[1] * 1.05
-  
+        self.pos += self.vel
+        out = (self.pos[:,0] < 0) | (self.pos[:,0] > self._wndpos.width) | \
+              (self.pos[:,1] < 0) | (self.pos[:,1] > self._wndpos.height)
+        self.vel[~out] *= 1.05
+        count = numpy.count_nonzero(out)
+        if count:
+            self.vel[out], self.pos[out] = self.init_stars(count)
+
+    def draw_frame(self):
+        self._surface.fill(self.black)
+        self.move_stars()
+        self.draw_stars(self.white)
+        self.damage()
+
     def do_work(self):
         if self._fclock.tick():
-            self._surface.fill(self.black)
-            self.move_stars()
-            self.draw_stars(self.white)
+            self.draw_frame()
     
+    def set_framerate(self, fr):
+        # Animate at up to 15 frames a second within the given framerate
+        if fr:
+            self._fclock.ontick(min(15, fr))
+        else:
+            self._fclock.ontick(15)
+
     def window_touch(self, x,y,pressed):
         if not pressed:
             self._origin = (x, y)
         return True
-    
+
+def benchmark(numstars, frames, size):
+    'Draw frames as fast as possible without a display and report the frame rate'
+    pygame.display.init()
+    pygame.font.init()
+    # Use the display format so drawing matches a real screen
+    screen = pygame.display.set_mode(size)
+    app = StarsApp(screen.get_rect(), screen, numstars)
+    start_t = report_t = pygame.time.get_ticks()
+    for frame in range(1, frames+1):
+        app.draw_frame()
+        app.pop_damage()
+        t = pygame.time.get_ticks()
+        if t - report_t >= 1000:
+            print("{} stars: {:.1f} FPS".format(numstars, frame * 1000.0 / (t - start_t)))
+            report_t = t
+    elapsed = max(1, pygame.time.get_ticks() - start_t)
+    print("{} stars, {} frames in {:.2f} sec: {:.1f} FPS".format(numstars, frames, elapsed / 1000.0, frames * 1000.0 / elapsed))
+    pygame.quit()
+
+if __name__ == "__main__":
+    # Run from the pgappmgr directory with PYTHONPATH=. python apps/stars.py
+    import argparse
+    import os
+    parser = argparse.ArgumentParser(description='Star field rendering benchmark')
+    parser.add_argument('--stars', type=int, default=2000, help='number of stars')
+    parser.add_argument('--frames', type=int, default=500, help='number of frames to draw')
+    parser.add_argument('--size', default='800x480', help='screen size as WIDTHxHEIGHT')
+    parser.add_argument('--display', action='store_true', help='draw to the display rather than headless')
+    args = parser.parse_args()
+    if not args.display:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    benchmark(args.stars, args.frames, tuple(int(v) for v in args.size.split('x')))
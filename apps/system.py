@@ -1,4 +1,7 @@
 from pgwindow import PygameApp, PygameButton
+from display import EinkRefresh
+from textcache import TextCache
+from fonts import Fonts
 import pygame
 import psutil
 import time
@@ -19,7 +22,7 @@ class RefreshBtn(PygameButton):
 
     def window_key(self, press, keyid, key):
         if (not press and key == 'KEY_ENTER'):
-            self._refreshscreen
+            self._refreshscreen()
         return True
 
     def window_touch(self, x, y, pressed):
@@ -28,11 +31,9 @@ class RefreshBtn(PygameButton):
         return True
 
     def _refreshscreen(self):
-        try:
-            self._einkrefresh_f = open("/sys/class/graphics/fb0/epd_refresh", "w+")
-            self._einkrefresh_f.write("1")
-            self._einkrefresh_f.close()
-        except (FileNotFoundError, IOError):
+        if EinkRefresh.enabled:
+            EinkRefresh.request_full()
+        else:
             print ("DEBUG: Cannot refresh e-ink display")
         
 class SystemInfo(PygameApp):
@@ -41,7 +42,7 @@ class SystemInfo(PygameApp):
         self._refreshbtn = RefreshBtn(rect = pygame.Rect(10,10,80,50))
         self._refreshbtn.name = "Refresh"
         self.add_child(self._refreshbtn)
-        self._screenfont = pygame.font.Font(None, 24)
+        self._screenfont = Fonts.get(None, 24)
         self._system_poll_t = 0
         self._system_poll = 2
         self._memory = psutil.virtual_memory()
@@ -77,7 +78,7 @@ class SystemInfo(PygameApp):
                                                                
         for line in lines:
             # Draw labels first and work out max width
-            text = self._screenfont.render(line[0], 1, (10,10,10))
+            text = TextCache.render(self._screenfont, line[0], 1, (10,10,10))
             pos = text.get_rect(top=pos.bottom,left=pos.left)
             val_start_at = max(val_start_at, pos.right)
             self._surface.blit(text, pos)
@@ -88,11 +89,11 @@ class SystemInfo(PygameApp):
 
         pos = pygame.Rect(val_start_at, 10,0,0)
         for line in lines:
-            text = self._screenfont.render(line[1], 1, (10,10,10))
+            text = TextCache.render(self._screenfont, line[1], 1, (10,10,10))
             pos = text.get_rect(top=pos.bottom,left=pos.left)
             self._surface.blit(text, pos)
+        self.damage()
 
-        
     def window_touch(self, x, y, pressed):
         return False
 
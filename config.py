@@ -72,6 +72,81 @@ class DisplayConfig(AppConfig):
     def rotate90(self):
         return self._config.getboolean('rotate 90', False)
 
+    @property
+    def directrender(self):
+        return self._config.getboolean('direct render', True)
+
+    @property
+    def backend(self):
+        'SDL or FRAMEBUFFER'
+        return self._config.get('backend', 'SDL').upper()
+
+    @property
+    def framebuffer(self):
+        return self._config.get('framebuffer', '/dev/fb0')
+
+    @property
+    def framebuffersize(self):
+        strsize = self._config.get('framebuffer size', None)
+        if strsize is None:
+            return None
+        return self.getintsize(strsize)
+
+    @property
+    def framebufferdepth(self):
+        return self._config.getint('framebuffer depth', None)
+
+    @property
+    def framebufferstride(self):
+        return self._config.getint('framebuffer stride', None)
+
+class EinkConfig(AppConfig):
+    def __init__(self, config, section='E-ink'):
+        self._config = None
+        if config.has_section(section):
+            self._config = config[section]
+
+    @property
+    def enabled(self):
+        if self._config is None:
+            return False
+        return self._config.getboolean('enabled', True)
+
+    @property
+    def refresh(self):
+        return self._config.get('refresh', '/sys/class/graphics/fb0/epd_refresh')
+
+    @property
+    def fullvalue(self):
+        return self._config.get('full value', '1')
+
+    @property
+    def partialvalue(self):
+        val = self._config.get('partial value', None)
+        if val is None or val.upper() == 'NONE' or val == '':
+            return None
+        return val
+
+    @property
+    def settle(self):
+        return self._config.getfloat('settle', 0.25)
+
+    @property
+    def maxwait(self):
+        return self._config.getfloat('max wait', 1.0)
+
+    @property
+    def interval(self):
+        return self._config.getfloat('interval', 1.0)
+
+    @property
+    def ghostlimit(self):
+        return self._config.getfloat('ghosting limit', 3.0)
+
+    @property
+    def fullarea(self):
+        return self._config.getfloat('full area', 0.5)
+
 class BatteryConfig(AppConfig):
     def __init__(self, config, section='Application'):
         self._appsection = config[section]
@@ -88,6 +163,11 @@ class BatteryConfig(AppConfig):
     def driver(self):
         return self._appsection.get('Battery Driver', None)
 
+    @property
+    def poll(self):
+        'Seconds between reads of the battery driver'
+        return self._config.getint('poll', 5)
+
 class SystemConfig(AppConfig):
     def __init__(self,config):
         self._config = config['System']
@@ -98,6 +178,31 @@ class SystemConfig(AppConfig):
             return None
         return self._config.getint('framerate', None)
 
+    @property
+    def governor(self):
+        'Adjust the framerate to use and load'
+        return self._config.getboolean('governor', True)
+
+    @property
+    def idleframerate(self):
+        return self._config.getint('idle framerate', 2)
+
+    @property
+    def idletimeout(self):
+        return self._config.getint('idle timeout', 30)
+
+    @property
+    def framebudget(self):
+        return self._config.getfloat('frame budget', 0.75)
+
+    @property
+    def inputkeys(self):
+        'Names of keys used. Input devices without touch or these keys are not opened'
+        keys = self._config.get('input keys', '')
+        if not keys:
+            return None
+        return [key.strip().upper() for key in keys.split(',') if key.strip()]
+
     @property
     def threaded(self):
         return self._config.getboolean('threaded', True)
@@ -106,6 +211,47 @@ class SystemConfig(AppConfig):
     def resourcedir(self):
         return self._config.get('resource dir')
 
+    @property
+    def queuelimit(self):
+        'Most messages waiting for dispatch. None for no limit'
+        limit = self._config.getint('message queue limit', 512)
+        if limit <= 0:
+            return None
+        return limit
+
+    @property
+    def queueoverflow(self):
+        'What to do when the message queue is full, merge or drop oldest'
+        return self._config.get('message queue overflow', 'merge').lower()
+
+    @property
+    def messagesocket(self):
+        'Unix socket path for other processes to use the message queue. None if not used'
+        path = self._config.get('message socket', '')
+        if not path or path.upper() == 'NONE':
+            return None
+        return path
+
+    @property
+    def messagestats(self):
+        'Count messages and time message callbacks'
+        return self._config.getboolean('message stats', False)
+
+    @property
+    def callbackbudget(self):
+        'Seconds a message callback can take before it is reported'
+        return self._config.getfloat('callback budget', 20) / 1000.0
+
+    @property
+    def statsinterval(self):
+        'Seconds between message stats summaries'
+        return self._config.getint('message stats interval', 60)
+
+    @property
+    def textcachesize(self):
+        'Size limit of rendered text cache in bytes'
+        return self._config.getint('text cache size', 1024) * 1024
+
 class NetworkConfig(AppConfig):
     def __init__(self, config, section='Network'):
         self._config = config[section]
@@ -213,6 +359,7 @@ class PgAppMgrConfig(object):
         self.network = None
         self.statusbar = None
         self.launcher = None
+        self.eink = None
 
     @property
     def isopen(self):
@@ -254,5 +401,12 @@ class PgAppMgrConfig(object):
         self.network = NetworkConfig(self._config)
         self.statusbar = StatusBarConfig(self._config)
         self.launcher = LauncherConfig(self._config)
+        self.eink = EinkConfig(self._config)
+
+    def section(self, name):
+        'Optional section for an app to read its own settings. None if missing'
+        if not self._isopen or not self._config.has_section(name):
+            return None
+        return self._config[name]
 
 Config = PgAppMgrConfig()
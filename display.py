@@ -0,0 +1,328 @@
+# Display output stages used by the main application loop to move the
+# drawn softscreen onto the physical display
+#
+# Copyright (C) 2019 Aidan Holmes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Email: aidanholmes@orbitalfruit.co.uk
+
+import pygame
+import time
+import os
+import stat
+import mmap
+import struct
+import fcntl
+from pgwindow import merge_rects
+
+try:
+    # Only needed to convert to 8 bit grey framebuffers
+    import numpy
+    import pygame.surfarray
+except ImportError:
+    numpy = None
+
+# Python 2.7 does not have FileNotFoundError exception
+try:
+    FileNotFoundError
+except NameError:
+    FileNotFoundError = IOError
+
+class RotateStage(object):
+    'Rotates changed regions of a source surface 90 degrees anti-clockwise into a target'
+    def __init__(self, source, target):
+        self._source = source
+        # The target persists between frames so only damaged regions
+        # need rotating into it
+        self._target = target
+
+    @property
+    def target(self):
+        return self._target
+
+    def rotate_rect(self, rect):
+        'Map a source rect to the target after rotation'
+        return pygame.Rect(rect.y,
+                           self._source.get_width() - rect.right,
+                           rect.height,
+                           rect.width)
+
+    def update(self, rects):
+        'Rotate each source rect into the target. Returns the target rects changed'
+        updated = []
+        for rect in rects:
+            dest = self.rotate_rect(rect)
+            region = pygame.transform.rotate(self._source.subsurface(rect), 90)
+            self._target.blit(region, dest)
+            updated.append(dest)
+        return updated
+
+class RefreshScheduler(object):
+    'Groups display damage into e-ink panel refreshes and picks partial or full refresh'
+    def __init__(self):
+        # Panel refresh file. Scheduler does nothing when None
+        self.target = None
+        # Values written to the target. No write for a partial refresh if None
+        self.fullvalue = '1'
+        self.partialvalue = None
+        # Seconds without new damage before a burst is refreshed
+        self.settle = 0.25
+        # Longest seconds damage waits for a burst to settle, so animation still refreshes
+        self.maxwait = 1.0
+        # Minimum seconds between writes to the panel
+        self.interval = 1.0
+        # Screens worth of partial refreshes before a full refresh clears ghosting
+        self.ghostlimit = 3.0
+        # Fraction of the screen damaged in one refresh which needs a full refresh
+        self.fullarea = 0.5
+
+        self._screenarea = 1
+        self._pending = []
+        self._pendingfull = False
+        self._last_damage_t = 0
+        self._first_damage_t = None
+        self._last_write_t = 0
+        self._ghosting = 0.0
+        self.fullcount = 0
+        self.partialcount = 0
+
+    @property
+    def enabled(self):
+        return self.target is not None
+
+    def configure(self, config, screensize):
+        'Take settings from the E-ink configuration'
+        self._screenarea = max(1, screensize[0] * screensize[1])
+        if not config.enabled:
+            self.target = None
+            return
+        self.target = config.refresh
+        self.fullvalue = config.fullvalue
+        self.partialvalue = config.partialvalue
+        self.settle = config.settle
+        self.maxwait = config.maxwait
+        self.interval = config.interval
+        self.ghostlimit = config.ghostlimit
+        self.fullarea = config.fullarea
+
+    def add_damage(self, rects, t=None):
+        'Add rects updated on the display'
+        if not self.enabled or not rects:
+            return
+        if t is None:
+            t = time.time()
+        self._damaged(t)
+        self._pending.extend(rects)
+
+    def request_full(self):
+        'Ask for a full refresh on the next write'
+        self._damaged(time.time())
+        self._pendingfull = True
+
+    def _damaged(self, t):
+        if not self._pending and not self._pendingfull:
+            # Start of a burst
+            self._first_damage_t = t
+        self._last_damage_t = t
+
+    def next_time(self):
+        'Time the next refresh is due or None if nothing is waiting'
+        if not self.enabled or (not self._pending and not self._pendingfull):
+            return None
+        settled_t = min(self._last_damage_t + self.settle, self._first_damage_t + self.maxwait)
+        return max(settled_t, self._last_write_t + self.interval)
+
+    def work(self, t=None):
+        'Refresh the panel if due. Returns the refresh done, full or partial, or None'
+        due = self.next_time()
+        if due is None:
+            return None
+        if t is None:
+            t = time.time()
+        if t < due:
+            # Still in a burst of updates or too soon after the last write
+            return None
+
+        area = 0
+        for rect in merge_rects(self._pending):
+            area = area + rect.width * rect.height
+        fraction = float(area) / self._screenarea
+
+        self._pending = []
+        self._last_write_t = t
+        if self._pendingfull or fraction >= self.fullarea or \
+           self._ghosting + fraction >= self.ghostlimit:
+            self._pendingfull = False
+            self._ghosting = 0.0
+            self.fullcount += 1
+            self._write(self.fullvalue)
+            return 'full'
+
+        self._ghosting = self._ghosting + fraction
+        self.partialcount += 1
+        if self.partialvalue is not None:
+            self._write(self.partialvalue)
+        return 'partial'
+
+    def _write(self, value):
+        try:
+            f = open(self.target, "w")
+            try:
+                f.write(value)
+            finally:
+                f.close()
+        except (FileNotFoundError, IOError):
+            print ("DEBUG: Cannot refresh e-ink display")
+
+EinkRefresh = RefreshScheduler()
+
+class FramebufferDisplay(object):
+    'Writes changed regions straight into a memory mapped Linux framebuffer or file'
+    FBIOGET_VSCREENINFO = 0x4600
+    FBIOGET_FSCREENINFO = 0x4602
+    def __init__(self, device, size=None, depth=None, stride=None):
+        self._fd = os.open(device, os.O_RDWR)
+        self._yoffset = 0
+        self._masks = None
+        self._grey = False
+        try:
+            self._read_screeninfo()
+        except (IOError, OSError):
+            # Not a framebuffer device. Layout must come from the configuration
+            if size is None or depth is None:
+                os.close(self._fd)
+                raise ValueError("Framebuffer size and depth required for {}".format(device))
+            self._size = (size[0], size[1])
+            self._depth = depth
+            self._linelength = size[0] * ((depth + 7) // 8)
+
+        # Configured values override anything read from the device
+        if size is not None:
+            self._size = (size[0], size[1])
+        if depth is not None:
+            if depth != self._depth:
+                self._masks = None
+            self._depth = depth
+        if stride is not None:
+            self._linelength = stride
+        elif size is not None or depth is not None:
+            self._linelength = max(self._linelength, self._size[0] * ((self._depth + 7) // 8))
+        if self._depth == 8:
+            self._grey = True
+        if self._grey and numpy is None:
+            os.close(self._fd)
+            raise ValueError("numpy is required for 8 bit grey framebuffer {}".format(device))
+
+        length = self._linelength * (self._size[1] + self._yoffset)
+        if stat.S_ISREG(os.fstat(self._fd).st_mode) and os.fstat(self._fd).st_size < length:
+            # Plain file standing in for a framebuffer
+            os.ftruncate(self._fd, length)
+        self._map = mmap.mmap(self._fd, length, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+        # Surface in the framebuffer pixel format used to convert regions
+        # before copying. Not needed when the source already matches
+        self._convert = None
+
+    def _read_screeninfo(self):
+        vinfo = bytearray(160)
+        fcntl.ioctl(self._fd, FramebufferDisplay.FBIOGET_VSCREENINFO, vinfo, True)
+        vals = struct.unpack_from('20I', bytes(vinfo))
+        # xres, yres, xres_virtual, yres_virtual, xoffset, yoffset,
+        # bits_per_pixel, grayscale then offset, length, msb_right of
+        # red, green, blue and transp
+        self._size = (vals[0], vals[1])
+        self._yoffset = vals[5]
+        self._depth = vals[6]
+        self._grey = vals[7] != 0
+        self._masks = tuple([((1 << vals[i+1]) - 1) << vals[i] for i in (8, 11, 14, 17)])
+
+        finfo = bytearray(128)
+        fcntl.ioctl(self._fd, FramebufferDisplay.FBIOGET_FSCREENINFO, finfo, True)
+        # id, smem_start, smem_len, type, type_aux, visual, xpanstep,
+        # ypanstep, ywrapstep, line_length
+        self._linelength = struct.unpack_from('16sL4I3HI', bytes(finfo))[-1]
+
+    @property
+    def size(self):
+        return self._size
+
+    def _target_format(self, source):
+        # Create the conversion surface if the source pixel format differs
+        masks = self._masks
+        if masks is None:
+            if self._depth == 16:
+                masks = (0xF800, 0x07E0, 0x001F, 0)
+            else:
+                masks = (0xFF0000, 0x00FF00, 0x0000FF, 0)
+        if source.get_bitsize() == self._depth and source.get_masks()[:3] == masks[:3]:
+            # Copy straight from the source
+            return None
+        if self._convert is None:
+            self._convert = pygame.Surface(self._size, 0, self._depth, masks)
+        return self._convert
+
+    def _update_grey(self, source, rects):
+        'Write the luminance of rects of source as one byte per pixel'
+        for rect in rects:
+            rect = rect.clip(source.get_rect())
+            if not rect.width or not rect.height:
+                continue
+            rgb = pygame.surfarray.array3d(source.subsurface(rect)).astype(numpy.uint32)
+            grey = (rgb[:,:,0] * 299 + rgb[:,:,1] * 587 + rgb[:,:,2] * 114) // 1000
+            # Arrays are indexed by x then y. Transpose for rows of bytes
+            data = grey.astype(numpy.uint8).T.tobytes()
+            dest = (rect.y + self._yoffset) * self._linelength + rect.x
+            for row in range(rect.height):
+                self._map[dest:dest + rect.width] = data[row * rect.width:(row + 1) * rect.width]
+                dest = dest + self._linelength
+
+    def update(self, source, rects):
+        'Copy rects of source into the framebuffer'
+        if self._grey:
+            self._update_grey(source, rects)
+            return
+        convert = self._target_format(source)
+        if convert is not None:
+            for rect in rects:
+                convert.blit(source, rect, rect)
+            source = convert
+
+        bpp = source.get_bytesize()
+        pitch = source.get_pitch()
+        proxy = source.get_buffer()
+        pixels = memoryview(proxy)
+        try:
+            for rect in rects:
+                rect = rect.clip(source.get_rect())
+                width = rect.width * bpp
+                dest = (rect.y + self._yoffset) * self._linelength + rect.x * bpp
+                src = rect.y * pitch + rect.x * bpp
+                if rect.x == 0 and pitch == self._linelength and width == pitch:
+                    # Whole rows. Copy in one go
+                    self._map[dest:dest + width * rect.height] = pixels[src:src + width * rect.height]
+                    continue
+                for row in range(rect.height):
+                    self._map[dest:dest + width] = pixels[src:src + width]
+                    dest = dest + self._linelength
+                    src = src + pitch
+        finally:
+            pixels.release()
+            del proxy
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            os.close(self._fd)
@@ -19,78 +19,269 @@
 
 import evdev
 import select
+import ctypes
+import ctypes.util
+import struct
+import errno
+import os
+from collections import deque
+
+class DirectoryWatch(object):
+  'Reports files created, deleted or changed in a directory using inotify'
+  IN_ATTRIB = 0x004
+  IN_MOVED_FROM = 0x040
+  IN_MOVED_TO = 0x080
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_NONBLOCK = 0o4000
+  IN_CLOEXEC = 0o2000000
+  EVENT = struct.Struct('iIII')
+
+  def __init__(self, path):
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    self.fd = libc.inotify_init1(DirectoryWatch.IN_NONBLOCK | DirectoryWatch.IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "Cannot start inotify")
+    mask = DirectoryWatch.IN_CREATE | DirectoryWatch.IN_DELETE | DirectoryWatch.IN_ATTRIB | \
+           DirectoryWatch.IN_MOVED_FROM | DirectoryWatch.IN_MOVED_TO
+    if libc.inotify_add_watch(self.fd, path.encode(), mask) < 0:
+      err = ctypes.get_errno()
+      os.close(self.fd)
+      raise OSError(err, "Cannot watch {}".format(path))
+
+  def read(self):
+    'Returns a list of (mask, filename) for changes since the last read'
+    changes = []
+    try:
+      data = os.read(self.fd, 4096)
+    except BlockingIOError:
+      return changes
+    offset = 0
+    while offset + DirectoryWatch.EVENT.size <= len(data):
+      wd, mask, cookie, length = DirectoryWatch.EVENT.unpack_from(data, offset)
+      offset += DirectoryWatch.EVENT.size
+      name = data[offset:offset+length].rstrip(b'\0').decode()
+      offset += length
+      changes.append((mask, name))
+    return changes
+
+  def close(self):
+    os.close(self.fd)
 
 class DeviceEvents(object):
-  def __init__(self):
-    # Register all devices for input
-    self._devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
-
-    self._got_x = False
-    self._got_y = False
-    # Cache touch inputs
-    self._input = {'type':'touch','press':0,'x':0,'y':0}
-    
-  def get_event(self):
-    evt = None
-    # Loop and process first input found. First devices
-    # will get priority until all messages exhausted
-    for device in self._devices:
+  # Keys used by the launcher and system windows. Devices with only other
+  # keys, such as power buttons, are not opened
+  DEFAULT_KEYS = ('KEY_ENTER', 'KEY_ESC', 'KEY_HOME', 'KEY_LEFT', 'KEY_RIGHT',
+                  'KEY_UP', 'KEY_DOWN', 'KEY_PAGEUP', 'KEY_PAGEDOWN')
+
+  def __init__(self, keys=None, watchdir='/dev/input', devices=None, opendevice=None):
+    'Read touch and key events from input devices in watchdir or from a list of devices'
+    if keys is None:
+      keys = DeviceEvents.DEFAULT_KEYS
+    self._keys = set(evdev.ecodes.ecodes[key] for key in keys if key in evdev.ecodes.ecodes)
+    # Opens devices plugged in to watchdir
+    self._opendevice = opendevice or evdev.InputDevice
+    self._watchdir = watchdir
+
+    # Events read for the report in progress on each device. Reports
+    # end with SYN_REPORT and are turned into touch and key events
+    self._reports = {}
+    # Devices which lost events. Events are ignored until the next SYN_REPORT
+    self._dropped = set()
+    # Touch and key events from complete reports waiting to be returned
+    self._events = deque()
+    # Cache touch inputs. Move is True for position changes while pressed
+    self._input = {'type':'touch','press':0,'x':0,'y':0,'move':False}
+
+    # Devices by file descriptor, all registered with epoll
+    self._devices = {}
+    self._epoll = select.epoll()
+
+    # Watch for devices plugged in and removed
+    self._watch = None
+    if watchdir is not None and os.path.isdir(watchdir):
       try:
-        evt = device.read_one()
-        if evt is not None and (evt.type == evdev.ecodes.EV_ABS or evt.type == evdev.ecodes.EV_KEY):
-          # event received which is key or abs input
-          break
-      except BlockingIOError:
-        pass
+        self._watch = DirectoryWatch(watchdir)
+        self._epoll.register(self._watch.fd, select.EPOLLIN)
+      except (OSError, AttributeError) as e:
+        print("DEBUG - input devices will not be hot plugged: {}".format(e))
+        self._watch = None
 
-    return self._filter_event(evt)
+    if devices is None:
+      devices = []
+      for path in evdev.list_devices():
+        device = self._open(path)
+        if device is not None:
+          devices.append(device)
+    for device in devices:
+      self.add_device(device)
+    
+  @property
+  def fds(self):
+    'File descriptor which is readable when there is input or devices change'
+    return [self._epoll.fileno()]
 
-  def get_blocking_event(self,timeout=None):
-    devices = {dev.fd: dev for dev in self._devices}
-    while True:
-      r, w, x = select.select(devices, [], [], timeout)
-      if len(r) <=0:
-        return None
-      evt = devices[r[0]].read_one()
-      
-      if evt is not None and (evt.type == evdev.ecodes.EV_ABS or evt.type == evdev.ecodes.EV_KEY):
-        # event received which is key or abs input
-        break
-
-    return self._filter_event(evt)
-
-  def _filter_event(self, evt):
-    # Check if any devices have input
-    if evt is None:
+  @property
+  def devices(self):
+    return list(self._devices.values())
+
+  def wanted(self, device):
+    'True if the device has touch position or any of the keys used'
+    try:
+      caps = device.capabilities(absinfo=False)
+      props = device.input_props()
+    except (OSError, AttributeError):
+      return True
+    if getattr(evdev.ecodes, 'INPUT_PROP_ACCELEROMETER', 6) in props:
+      return False
+    axes = caps.get(evdev.ecodes.EV_ABS, [])
+    if evdev.ecodes.ABS_X in axes and evdev.ecodes.ABS_Y in axes:
+      return True
+    return any(code in self._keys for code in caps.get(evdev.ecodes.EV_KEY, []))
+
+  def _open(self, path):
+    'Open an input device. Returns None if it cannot be opened or is not wanted'
+    try:
+      device = self._opendevice(path)
+    except OSError:
+      # Not ready yet. Tried again when permissions change
       return None
-    
-    if evt.type == evdev.ecodes.EV_KEY and evt.code == evdev.ecodes.BTN_TOUCH:
-      if self._input['press'] != evt.value:
-        self._input['press'] = evt.value
-        return self._input.copy()
-    elif evt.type == evdev.ecodes.EV_ABS:
-      if evt.code == evdev.ecodes.ABS_X:
-        self._input['x'] = evt.value
-        self._got_x = True
-      elif evt.code == evdev.ecodes.ABS_Y:
-        self._input['y'] = evt.value
-        self._got_y = True
-    elif evt.type == evdev.ecodes.EV_KEY:
-      input = {}
-      input['type'] = 'key'
-      input['code'] = evt.code
-      input['press'] = evt.value
-      try:
-        input['key'] = evdev.ecodes.KEY[evt.code]
-      except KeyError:
-        input['key'] = ''
-      return input
-
-    if self._got_y and self._got_x:
-      self._got_y = False
-      self._got_x = False
-      self._input['type'] = 'touch'
-      self._input['press'] = 1
-      return self._input.copy()
+    if not self.wanted(device):
+      device.close()
+      return None
+    return device
+
+  def add_device(self, device):
+    'Start reading events from a device'
+    if device.fd in self._devices:
+      return
+    self._devices[device.fd] = device
+    self._reports[device.fd] = []
+    self._epoll.register(device.fd, select.EPOLLIN)
 
-    return None        
+  def remove_device(self, device):
+    'Stop reading events from a device and close it'
+    if self._devices.pop(device.fd, None) is None:
+      return
+    self._reports.pop(device.fd, None)
+    self._dropped.discard(device.fd)
+    try:
+      self._epoll.unregister(device.fd)
+    except (OSError, ValueError):
+      pass
+    try:
+      device.close()
+    except OSError:
+      pass
+
+  def _device_changes(self):
+    'Open devices which have appeared and remove devices which have gone'
+    for mask, name in self._watch.read():
+      path = os.path.join(self._watchdir, name)
+      known = [dev for dev in self._devices.values() if getattr(dev, 'path', None) == path]
+      if mask & (DirectoryWatch.IN_DELETE | DirectoryWatch.IN_MOVED_FROM):
+        for device in known:
+          self.remove_device(device)
+      elif not known and name.startswith('event'):
+        # New device or permissions changed on one that couldn't be opened
+        device = self._open(path)
+        if device is not None:
+          self.add_device(device)
+
+  def _poll(self, timeout):
+    'Wait up to timeout seconds for input and read every ready device'
+    for fd, mask in self._epoll.poll(timeout):
+      if self._watch is not None and fd == self._watch.fd:
+        self._device_changes()
+      elif fd in self._devices:
+        if mask & (select.EPOLLERR | select.EPOLLHUP) and not mask & select.EPOLLIN:
+          self.remove_device(self._devices[fd])
+        else:
+          self._read_device(self._devices[fd])
+
+  def get_event(self):
+    'Returns the next touch or key event or None if there is no input'
+    if not self._events:
+      self._poll(0)
+    if self._events:
+      return self._events.popleft()
+    return None
+
+  def get_blocking_event(self,timeout=None):
+    'Wait up to timeout seconds for a touch or key event. Returns None if there was no input'
+    if timeout is None:
+      timeout = -1
+    if not self._events:
+      self._poll(timeout)
+    if self._events:
+      return self._events.popleft()
+    return None
+
+  def close(self):
+    for device in list(self._devices.values()):
+      self.remove_device(device)
+    if self._watch is not None:
+      self._watch.close()
+    self._epoll.close()
+
+  def _read_device(self, device):
+    'Read all waiting events from a device and add events for complete reports'
+    report = self._reports[device.fd]
+    try:
+      for evt in device.read():
+        if evt.type == evdev.ecodes.EV_SYN:
+          if evt.code == evdev.ecodes.SYN_REPORT:
+            if device.fd in self._dropped:
+              self._dropped.discard(device.fd)
+            else:
+              self._report(report)
+            del report[:]
+          elif evt.code == evdev.ecodes.SYN_DROPPED:
+            # Kernel buffer overran. The report in progress is incomplete
+            self._dropped.add(device.fd)
+            del report[:]
+        elif evt.type == evdev.ecodes.EV_ABS or evt.type == evdev.ecodes.EV_KEY:
+          report.append(evt)
+    except BlockingIOError:
+      pass
+    except OSError as e:
+      if e.errno == errno.ENODEV:
+        # Unplugged
+        self.remove_device(device)
+      else:
+        raise
+
+  def _report(self, report):
+    'Add one touch event and any key events for a complete report'
+    press = None
+    moved = False
+    for evt in report:
+      if evt.type == evdev.ecodes.EV_KEY and evt.code == evdev.ecodes.BTN_TOUCH:
+        press = evt.value
+      elif evt.type == evdev.ecodes.EV_ABS:
+        if evt.code == evdev.ecodes.ABS_X:
+          self._input['x'] = evt.value
+          moved = True
+        elif evt.code == evdev.ecodes.ABS_Y:
+          self._input['y'] = evt.value
+          moved = True
+      elif evt.type == evdev.ecodes.EV_KEY:
+        input = {}
+        input['type'] = 'key'
+        input['code'] = evt.code
+        input['press'] = evt.value
+        try:
+          input['key'] = evdev.ecodes.KEY[evt.code]
+        except KeyError:
+          input['key'] = ''
+        self._events.append(input)
+
+    if press is not None and press != self._input['press']:
+      # Press or release at the position in the report
+      self._input['press'] = press
+      self._input['move'] = False
+      self._events.append(self._input.copy())
+    elif moved:
+      self._input['move'] = self._input['press'] == 1
+      self._input['press'] = 1
+      self._events.append(self._input.copy())
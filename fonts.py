@@ -0,0 +1,63 @@
+# Shared font objects. Fonts are loaded once per face and size and
+# reused by every window and app
+#
+# Copyright (C) 2019 Aidan Holmes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Email: aidanholmes@orbitalfruit.co.uk
+
+import pygame
+from threading import Lock
+
+class FontRegistry(object):
+    def __init__(self):
+        # Font objects keyed by (face, size). Face of None is the pygame default font
+        self._fonts = {}
+        self._lock = Lock()
+
+    def get(self, face, size):
+        'Return the shared font for face and size. Loaded on first use'
+        key = (face, size)
+        self._lock.acquire()
+        try:
+            font = self._fonts.get(key)
+            if font is None:
+                font = pygame.font.Font(face, size)
+                self._fonts[key] = font
+            return font
+        finally:
+            self._lock.release()
+
+    @property
+    def resident(self):
+        'list of (face, size) currently loaded'
+        self._lock.acquire()
+        try:
+            return list(self._fonts.keys())
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._fonts)
+
+    def clear(self):
+        'Drop all fonts. Only safe when no windows hold a font'
+        self._lock.acquire()
+        try:
+            self._fonts.clear()
+        finally:
+            self._lock.release()
+
+Fonts = FontRegistry()
@@ -0,0 +1,155 @@
+# Framerate governor. Sets the running framerate from the rate apps ask
+# for, how busy the frames are and how recently the screen was used
+#
+# Copyright (C) 2019 Aidan Holmes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Email: aidanholmes@orbitalfruit.co.uk
+
+from appmsg import *
+from msgqueue import AppPublisher, AppSubscriber
+import psutil
+import time
+
+class FramerateGovernor(AppPublisher, AppSubscriber):
+    # Weight of the latest frame in the running averages
+    AVERAGE_WEIGHT = 0.1
+    def __init__(self, mq, default, idlerate=2, idletimeout=30, budget=0.75, enabled=True):
+        AppPublisher.__init__(self, mq)
+        AppSubscriber.__init__(self, mq)
+        self.register_message(MSG_APP_FRAMERATE)
+        self.subscribe_message(MSG_APP_FRAMERATE, FRAMERATE_REQUEST, self._requestevent)
+        self.subscribe_message(MSG_TOUCH_INPUT, None, self._inputevent)
+        self.subscribe_message(MSG_KEY_INPUT, None, self._inputevent)
+
+        self.enabled = enabled
+        # Lowest rate used when nobody is using the screen
+        self.idlerate = idlerate
+        # Seconds without input before dropping to the idle rate
+        self.idletimeout = idletimeout
+        # Fraction of time frames are allowed to take
+        self.budget = budget
+
+        # Framerate from the configuration and the rate asked for by the app
+        self._default = default
+        self._requested = default
+        self._rate = default
+
+        self._input_t = time.time()
+        self._update_t = 0
+        self._update_poll = 0.5 # sec
+        # Running averages of seconds per frame and frames which changed the screen
+        self._frame_cost = 0.0
+        self._damage_ratio = 1.0
+        self._cpu = 0.0
+        self._cpu_poll_t = 0
+        self._cpu_poll = 2 # sec
+        self._cpu_times = self._read_cpu_times()
+
+    @property
+    def rate(self):
+        'Framerate currently in use. None runs as fast as possible'
+        return self._rate
+
+    @property
+    def frame_cost(self):
+        return self._frame_cost
+
+    @property
+    def damage_ratio(self):
+        return self._damage_ratio
+
+    def _requestevent(self, msgid, context, fr):
+        if fr is None:
+            self._requested = self._default
+        else:
+            self._requested = fr
+        # Starting or stopping an app counts as using the screen
+        self._input_t = time.time()
+        self.update(True)
+
+    def _inputevent(self, msgid, context, message):
+        self._input_t = time.time()
+        if self._rate != self._requested:
+            # Speed up straight away for interaction
+            self.update()
+
+    def frame_done(self, cost, damaged):
+        'Record how long a frame took and whether it changed the screen'
+        w = FramerateGovernor.AVERAGE_WEIGHT
+        self._frame_cost = self._frame_cost * (1-w) + cost * w
+        self._damage_ratio = self._damage_ratio * (1-w) + (1.0 if damaged else 0.0) * w
+
+        t = time.time()
+        if t > self._cpu_poll_t + self._cpu_poll:
+            self._cpu_poll_t = t
+            self._cpu = self._cpu_percent()
+        if t > self._update_t + self._update_poll:
+            self.update()
+
+    def _read_cpu_times(self):
+        'Total and idle CPU seconds'
+        times = psutil.cpu_times()
+        # Guest time is also counted in user time
+        total = sum(times) - getattr(times, 'guest', 0) - getattr(times, 'guest_nice', 0)
+        return total, times.idle + getattr(times, 'iowait', 0)
+
+    def _cpu_percent(self):
+        '''Percentage of CPU in use since the last call. Worked out here rather than with
+        psutil.cpu_percent, which shares its last sample with the status bar'''
+        total, idle = self._read_cpu_times()
+        last_total, last_idle = self._cpu_times
+        self._cpu_times = (total, idle)
+        if total <= last_total:
+            return self._cpu
+        busy = (total - last_total) - (idle - last_idle)
+        return max(0.0, min(100.0, busy * 100.0 / (total - last_total)))
+
+    def target_rate(self):
+        'Work out the framerate to use now'
+        top = self._requested
+        if not self.enabled:
+            return top
+        if not top:
+            # As fast as possible, limited by the time frames take
+            if self._frame_cost <= 0:
+                return None
+            top = self.budget / self._frame_cost
+
+        if time.time() > self._input_t + self.idletimeout:
+            return min(top, self.idlerate)
+
+        target = float(top)
+        # Frames which don't change the screen are wasted
+        target = target * max(0.25, self._damage_ratio)
+        # Keep frames within the CPU budget
+        if self._frame_cost > 0:
+            target = min(target, self.budget / self._frame_cost)
+        if self._cpu > 90:
+            target = target / 2
+        return int(max(min(top, self.idlerate), min(top, round(target))))
+
+    def update(self, force=False):
+        'Announce a new framerate with MSG_APP_FRAMERATE if it has changed enough'
+        self._update_t = time.time()
+        target = self.target_rate()
+        if target == self._rate:
+            return
+        if not force and target is not None and self._rate is not None:
+            # Ignore small changes to avoid announcing every update
+            if abs(target - self._rate) < max(1, self._rate * 0.1):
+                return
+        self._rate = target
+        self.message_queue.post_message(MSG_APP_FRAMERATE, FRAMERATE_SET, target)
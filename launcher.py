@@ -29,6 +29,8 @@ from os.path import join, isfile
 from msgqueue import AppSubscriber, AppPublisher
 from threading import Lock
 from pgwindow import PygameApp
+from textcache import TextCache
+from fonts import Fonts
 
 def app_guard(func,handler=None):
     def guard_call(*args, **kwargs):
@@ -45,11 +47,27 @@ class PygameLauncher(AppSubscriber, AppPublisher, PygameApp):
     def __init__(self, mq, *args, **kwargs):
         AppSubscriber.__init__(self,mq)
         PygameApp.__init__(self, *args, **kwargs)
+        self.subscribe_message(MSG_APP_FRAMERATE, FRAMERATE_SET, self._framerateevent)
         sys.path.insert(0, Config.launcher.launcherdir)
         self._apps = []
         self._defaulticon = pygame.image.load(join(Config.system.resourcedir,Config.launcher.defaulticon))
         self._defaulticon = pygame.transform.scale(self._defaulticon, Config.launcher.iconsize)
-        self._iconfont = pygame.font.Font(None, Config.launcher.fontsize)
+        self._iconfont = Fonts.get(None, Config.launcher.fontsize)
+
+        self._background = Config.launcher.background
+        self._iconstride = Config.launcher.stride
+        self._iconrowheight = Config.launcher.rowheight
+
+        # Pre-drawn icon tiles. Each app has a row with the normal
+        # tile on the left and the active tile on the right
+        self._atlas = None
+        self._activeicon = None
+        # Icons needing a redraw without redrawing the whole launcher
+        self._dirtyicons = set()
+        # Icons are shown a page at a time in a grid of columns and rows
+        self._page = 0
+        self._columns = 1
+        self._rows = 1
 
         self.read_apps()
         self._redraw = True
@@ -58,10 +76,8 @@ class PygameLauncher(AppSubscriber, AppPublisher, PygameApp):
         self._appobj = None
 
         self._lock = Lock()
-
-        self._background = Config.launcher.background
-        self._iconstride = Config.launcher.stride
-        self._iconrowheight = Config.launcher.rowheight
+        self._appframerate = Config.system.framerate
+        self._newframerate = False
         
     def keyinput(self,message):
         # override key dispatcher
@@ -90,6 +106,10 @@ class PygameLauncher(AppSubscriber, AppPublisher, PygameApp):
                 self.select_next_icon()
             elif message['key'] == 'KEY_LEFT':
                 self.select_prev_icon()
+            elif message['key'] == 'KEY_PAGEDOWN':
+                self.set_page(self._page + 1)
+            elif message['key'] == 'KEY_PAGEUP':
+                self.set_page(self._page - 1)
 
         return True 
                 
@@ -115,75 +135,125 @@ class PygameLauncher(AppSubscriber, AppPublisher, PygameApp):
         finally:
             self._lock.release()
 
+        icon = self.icon_at(norm['x'], norm['y'])
         if norm['press']:
-            self._keydown = norm.copy()
-            for icon in self._apps:
-                state = icon['active']
-                if icon['rect'].collidepoint(norm['x'], norm['y']):
-                    icon['active'] = True
-                else:
-                    icon['active'] = False
-
-                if state != icon['active']:
-                    #state of an icon changed
-                    self._redraw = True
+            if self._keydown is None or not norm.get('move'):
+                # Remember where the touch started. Moves while pressed don't restart it
+                self._keydown = norm.copy()
+            if abs(norm['x'] - self._keydown['x']) > self._iconstride / 2:
+                # Swiping between pages. Don't select icons passed over
+                self.select_icon(None)
+            else:
+                self.select_icon(icon)
 
         elif self._keydown:
             # Touch pressed and now up
+            swipe = norm['x'] - self._keydown['x']
             self._keydown = None
-            for icon in self._apps:
-                if icon['rect'].collidepoint(
-                        norm['x'],
-                        norm['y']) and icon['active']:
-                    self.run_app(icon)
+            if abs(swipe) > self._iconstride / 2:
+                # Swipe left for next page and right for previous page
+                self.select_icon(None)
+                if swipe < 0:
+                    self.set_page(self._page + 1)
+                else:
+                    self.set_page(self._page - 1)
+            elif icon and icon['active']:
+                self.run_app(icon)
 
         # Never declare the input to be handled
         return False
     
-    def select_active_icon(self):
-        for icon in self._apps:
-            if icon['active']:
-                return icon
+    @property
+    def page_size(self):
+        return self._columns * self._rows
+
+    @property
+    def pages(self):
+        return max(1, (len(self._apps) + self.page_size - 1) // self.page_size)
+
+    def set_page(self, page):
+        'Show a page of icons. Out of range pages are ignored'
+        if page < 0 or page >= self.pages or page == self._page:
+            return
+        self._page = page
+        self._redraw = True
+
+    def icon_at(self, x, y):
+        'Returns the app icon at window position x,y or None'
+        if x < 0 or y < 0:
+            return None
+        # Work out the grid cell directly from the position
+        col = int(x // self._iconstride)
+        row = int(y // self._iconrowheight)
+        if col >= self._columns or row >= self._rows:
+            return None
+        index = self._page * self.page_size + row * self._columns + col
+        if index < len(self._apps):
+            return self._apps[index]
         return None
 
+    def icon_rect(self, icon):
+        'Window rect of an icon or None if the icon is not on the current page'
+        page, slot = divmod(icon['tile'], self.page_size)
+        if page != self._page:
+            return None
+        row, col = divmod(slot, self._columns)
+        return pygame.Rect(col * self._iconstride, row * self._iconrowheight,
+                           self._iconstride, self._iconrowheight)
+
+    def select_active_icon(self):
+        return self._activeicon
+
+    def select_icon(self, icon):
+        'Make icon the active icon. None clears the selection'
+        prev = self._activeicon
+        if prev is icon:
+            return
+        if prev:
+            prev['active'] = False
+            self._dirtyicons.add(prev['tile'])
+        if icon:
+            icon['active'] = True
+            self._dirtyicons.add(icon['tile'])
+            # Bring the selected icon into view
+            self.set_page(icon['tile'] // self.page_size)
+        self._activeicon = icon
+
     def select_prev_icon(self):
-        prev = None
-        active_found = False
         if not len(self._apps):
             return None
 
-        for icon in self._apps:
-            if icon['active']:
-                active_found = True
-                if prev:
-                    prev['active'] = True
-                    icon['active'] = False
-                    break
-            prev = icon
-        self._redraw = True
-        if not active_found:
-            self._apps[-1]['active'] = True
+        if not self._activeicon:
+            self.select_icon(self._apps[-1])
+        elif self._activeicon['tile'] > 0:
+            self.select_icon(self._apps[self._activeicon['tile']-1])
             
     def select_next_icon(self):
-        prev = None
         if not len(self._apps):
             return None
 
-        for icon in self._apps:
-            if icon['active']:
-                prev = icon
-            elif prev:
-                icon['active'] = True
-                prev['active'] = False
-                break
-        self._redraw = True
-        if not prev:
-            self._apps[0]['active'] = True
+        if not self._activeicon:
+            self.select_icon(self._apps[0])
+        elif self._activeicon['tile'] < len(self._apps)-1:
+            self.select_icon(self._apps[self._activeicon['tile']+1])
+
+    def _framerateevent(self, msgid, context, fr):
+        # Framerate from the governor. Passed to the running app
+        # from work as this can be posted while holding the lock
+        self._appframerate = fr
+        self._newframerate = True
+
+    @property
+    def app_running(self):
+        return self._appobj is not None
 
     def stop_app(self):
         if self._appobj:
             # App is running. Call close
             app_guard(self._appobj.close)()
+            if isinstance(self._appobj, AppSubscriber):
+                # Stop messages to an app that has gone
+                self._appobj.unsubscribe_all()
             
             # Delete import and app object
             del self._appobj
@@ -192,7 +262,7 @@ class PygameLauncher(AppSubscriber, AppPublisher, PygameApp):
             self._runningappmodule = None
 
             # Restore framerate
-            self.message_queue.post_message(MSG_APP_FRAMERATE, None, None)
+            self.message_queue.post_message(MSG_APP_FRAMERATE, FRAMERATE_REQUEST, None)
 
             # refresh screen
             self._redraw = True
@@ -205,12 +275,13 @@ class PygameLauncher(AppSubscriber, AppPublisher, PygameApp):
                 runclass = appinfo['class']
 
             if 'framerate' in appinfo and isinstance(appinfo['framerate'], int):
-                self.message_queue.post_message(MSG_APP_FRAMERATE, None, appinfo['framerate'])
+                self.message_queue.post_message(MSG_APP_FRAMERATE, FRAMERATE_REQUEST, appinfo['framerate'])
 
             if hasattr(self._runningappmodule, runclass):
                 class_ = getattr(self._runningappmodule, runclass)
                 
                 self._appobj = class_(self._wndpos, self._surface)
+                self._newframerate = True
             else:
                 print("DEBUG - cannot find class {}".format(runclass))
                 del self._runningappmodule
@@ -229,41 +300,81 @@ class PygameLauncher(AppSubscriber, AppPublisher, PygameApp):
                     modinfo = m.AppInfo.copy()
                     modinfo['module'] = module_name
                     modinfo['active'] = False
+                    modinfo['tile'] = len(self._apps)
                     self._apps.append(modinfo)
                 except ImportError:
                     pass
+        self._activeicon = None
+        self.build_atlas()
+        self.layout_icons()
+        self._redraw = True
 
-    def draw(self):
+    def load_icon(self, filename):
+        'Load an app icon from the resource directory. Returns the default icon on failure'
+        if not filename:
+            return self._defaulticon
+        try:
+            img = pygame.image.load(join(Config.system.resourcedir, filename))
+            return pygame.transform.scale(img, Config.launcher.iconsize)
+        except (pygame.error, IOError):
+            return self._defaulticon
+
+    def build_atlas(self):
+        'Draw the normal and active tiles for every app once'
         stride = self._iconstride
         row = self._iconrowheight
-        drawx = 0
-        drawy = 0
-        self._surface.fill(self._background)
+        self._atlas = pygame.Surface((stride*2, row*max(1,len(self._apps)))).convert()
+        self._atlas.fill(self._background)
+        images = {}
         for icon in self._apps:
-            if not hasattr(icon, 'wnd'):
-                wnd = pygame.Surface((stride,row)).convert()
-                icon['wnd'] = wnd
-                wnd.fill(self._background)
-                icon['rect'] = wnd.get_rect(left=drawx, top=drawy)
-                iconrect = self._defaulticon.get_rect(center=(stride/2,row/2))
-                wnd.blit(self._defaulticon, iconrect)
-                text = self._iconfont.render(icon['iconname'], 1, (10,10,10))
-                wnd.blit(text, text.get_rect(centerx=stride/2,top=iconrect.bottom))
-            if icon['active']:
-                wnd = icon['wnd'].copy()
-                wnd.fill(self._background)
-                wnd.blit(icon['wnd'],(0,0),None, pygame.BLEND_SUB)
-                self._surface.blit(wnd, icon['rect'])
-            else:
-                self._surface.blit(icon['wnd'], icon['rect'])
-
-            # advance and wrap the icons until no more room
-            drawx = stride + drawx
-            if drawx + stride > self._wndpos.width:
-                drawx = 0
-                drawy = row + drawy
-            if drawy + row > self._wndpos.height:
-                break
+            tile = self.tile_rect(icon)
+            filename = icon.get('icon')
+            if filename not in images:
+                images[filename] = self.load_icon(filename)
+            img = images[filename]
+
+            # Draw within the tile so nothing spills into the next one
+            wnd = self._atlas.subsurface(tile)
+            iconrect = img.get_rect(center=(stride/2,row/2))
+            wnd.blit(img, iconrect)
+            text = TextCache.render(self._iconfont, icon['iconname'], 1, (10,10,10))
+            wnd.blit(text, text.get_rect(centerx=stride/2,top=iconrect.bottom))
+
+            # Active tile is the inverse of the normal tile
+            self._atlas.blit(wnd.copy(), tile.move(stride, 0), None, pygame.BLEND_SUB)
+
+    def tile_rect(self, icon):
+        'Rect of an icon tile in the atlas'
+        rect = pygame.Rect(0, icon['tile']*self._iconrowheight, self._iconstride, self._iconrowheight)
+        if icon['active']:
+            rect.x = self._iconstride
+        return rect
+
+    def layout_icons(self):
+        'Work out the grid of icons which fit on a page'
+        self._columns = max(1, self._wndpos.width // self._iconstride)
+        self._rows = max(1, self._wndpos.height // self._iconrowheight)
+        self._page = min(self._page, self.pages - 1)
+
+    def draw_icon(self, icon):
+        rect = self.icon_rect(icon)
+        if rect:
+            self._surface.blit(self._atlas, rect, self.tile_rect(icon))
+            self.damage(rect)
+
+    def draw(self):
+        self._surface.fill(self._background)
+        # Only icons on the current page are drawn
+        first = self._page * self.page_size
+        for icon in self._apps[first:first + self.page_size]:
+            self._surface.blit(self._atlas, self.icon_rect(icon), self.tile_rect(icon))
+        if self.pages > 1:
+            # Page indicator in the space below the icons
+            text = TextCache.render(self._iconfont, "{}/{}".format(self._page+1, self.pages), 1, (10,10,10))
+            pos = text.get_rect(centerx=self._wndpos.width/2, bottom=self._wndpos.height)
+            if pos.top >= self._rows * self._iconrowheight:
+                self._surface.blit(text, pos)
+        self.damage()
         
     def work(self):
         # work and key/touch events are separate threads. Lock the check
@@ -271,17 +382,30 @@ class PygameLauncher(AppSubscriber, AppPublisher, PygameApp):
         self._lock.acquire()
         try:
             if self._appobj:
+                if self._newframerate:
+                    self._newframerate = False
+                    app_guard(self._appobj.set_framerate, self.stop_app)(self._appframerate)
                 # Pass through touch inputs to running app
                 app_guard(self._appobj.do_work, self.stop_app)()
+                # The app draws into the launcher surface. Pick up what changed
+                if self._appobj:
+                    for rect in self._appobj.pop_damage():
+                        self.damage(rect)
                 return None
         finally:
             self._lock.release()
 
         # Only redraw when required. Screen presses
         # and other events will trigger redraw
+        dirty = self._dirtyicons
+        self._dirtyicons = set()
         if self._redraw:
             self.draw()
             self._redraw = False
+        else:
+            # Only icons changing selection are drawn again
+            for tile in dirty:
+                self.draw_icon(self._apps[tile])
 
     def suspend(self):
         pass
@@ -19,16 +19,24 @@
 # Email: aidanholmes@orbitalfruit.co.uk
 
 from appmsg import *
+import appmsg
 from config import Config
 import threading
 import pygame
 import time
 import socket
 import signal
+import select
 from msgqueue import AppPublisher, AppSubscriber, MessageQueue
 from syswnd import SystemWindow
 from events import DeviceEvents
+from display import RotateStage, EinkRefresh, FramebufferDisplay
+from textcache import TextCache
+from governor import FramerateGovernor
+from msgsocket import MessageServer
+from msgrecord import MessageRecorder, MessageReplay
 from os.path import join
+import os
 import argparse
 
 # Python 2.7 does not have FileNotFoundError exception
@@ -38,7 +46,7 @@ except NameError:
     FileNotFoundError = IOError
 
 class System(AppPublisher):
-    def __init__(self, mq):
+    def __init__(self, mq, screensize, replay=False):
         AppPublisher.__init__(self, mq)
         self.register_message(MSG_TOUCH_INPUT)
         self.register_message(MSG_KEY_INPUT)
@@ -48,7 +56,14 @@ class System(AppPublisher):
         self.register_message(MSG_SYS_NETWORK)
 
         self._quit = False
-        self._input = DeviceEvents()
+        # Replayed sessions post recorded input, battery and network messages
+        # so devices aren't read or polled
+        self._replay = replay
+        self._input = None
+        if not replay:
+            self._input = DeviceEvents(Config.system.inputkeys)
+        # Physical display size used to rotate touch inputs
+        self._screensize = screensize
 
         self._battstatus = False
         self._battcapacity = False
@@ -70,7 +85,8 @@ class System(AppPublisher):
         self._network_query_t = 0
         self._last_network_ip = ''
 
-        if Config.system.threaded:
+        self._ithread = None
+        if Config.system.threaded and not replay:
             self._ithread = threading.Thread(target=self._do_inputs)
             self._ithread.start()
                             
@@ -98,17 +114,38 @@ class System(AppPublisher):
                     evt['y'] *= Config.display.scaley
                     if Config.display.rotate90:
                         tmp = evt['x']
-                        evt['x'] = pygame.display.get_surface().get_height() - evt['y']
+                        evt['x'] = self._screensize[1] - evt['y']
                         evt['y'] = tmp
                     self.message_queue.post_message(MSG_TOUCH_INPUT, INPUT_ABSOLUTE, evt)
 
+    def input_fds(self):
+        'File descriptors to wait on for input when not threaded'
+        if self._ithread or not self._input:
+            return []
+        return self._input.fds
+
+    def next_work_time(self):
+        'Time that do_work next has something to do'
+        if self._replay:
+            return float('inf')
+        t = self._network_query_t + Config.network.statuspoll
+        if self._battcapacity:
+            t = min(t, self._battcapacity_t + Config.battery.poll)
+        if self._battstatus:
+            t = min(t, self._battstatus_t + Config.battery.poll)
+        return t
+
     def close(self):
         self._quit = True
-        if Config.system.threaded:
+        if self._ithread:
             self._ithread.join(8.0)
+        if self._input:
+            self._input.close()
         
     def do_work(self):
         'Do some work. This should operate quickly and return'
+        if self._replay:
+            return
         t = time.time()
 
         if not Config.system.threaded:
@@ -119,26 +156,26 @@ class System(AppPublisher):
                 elif evt['type'] == 'touch':
                     if Config.display.rotate90:
                         tmp = evt['x']
-                        evt['x'] = pygame.display.get_surface().get_height() - evt['y']
+                        evt['x'] = self._screensize[1] - evt['y']
                         evt['y'] = tmp
                     self.message_queue.post_message(MSG_TOUCH_INPUT, INPUT_ABSOLUTE, evt)
                 evt = self._input.get_event()
 
         if self._battcapacity:
-            if t > self._battcapacity_t+Config.battery.getint('poll'):
+            if t > self._battcapacity_t+Config.battery.poll:
                 self._battcapacity_t = t
                 try:
                     self._battcapacity_f.seek(0)
-                    self.message_queue.post_message(MSG_SYS_BATTERY, 'capacity', self._battcapacity_f.read().rstrip())
+                    self.message_queue.post_message(MSG_SYS_BATTERY, BATT_CAPACITY, self._battcapacity_f.read().rstrip())
                 except IOError:
                     pass
 
         if self._battstatus:
-            if t > self._battstatus_t+Config.battery.getint('poll'):
+            if t > self._battstatus_t+Config.battery.poll:
                 self._battstatus_t = t
                 try:
                     self._battstatus_f.seek(0)
-                    self.message_queue.post_message(MSG_SYS_BATTERY, 'status', self._battstatus_f.read().rstrip())
+                    self.message_queue.post_message(MSG_SYS_BATTERY, BATT_STATUS, self._battstatus_f.read().rstrip())
                 except IOError:
                     pass
 
@@ -152,38 +189,100 @@ class System(AppPublisher):
 class App(MessageQueue):
     def __init__(self, args):
         MessageQueue.__init__(self)
-        self._clock = pygame.time.Clock()
-        self._init_pygame()
 
         # Open the Config singleton
         Config.open(args.config)
+        TextCache.limit = Config.system.textcachesize
+        self.set_queue_limit(Config.system.queuelimit, Config.system.queueoverflow)
+        # Only the latest position of a drag is needed
+        self.set_coalesce(MSG_TOUCH_INPUT, lambda old, new: old.get('move') and new.get('move'))
+        if Config.system.messagestats:
+            names = {value: name for name, value in vars(appmsg).items() if name.startswith('MSG_')}
+            self.enable_stats(Config.system.callbackbudget, Config.system.statsinterval, names)
+
+        # Record input and system messages, or replay a recording instead of reading devices
+        self._msgrecorder = None
+        if args.record:
+            self._msgrecorder = MessageRecorder(args.record, (MSG_TOUCH_INPUT, MSG_KEY_INPUT,
+                                                           MSG_SYS_BATTERY, MSG_SYS_NETWORK))
+            self.set_recorder(self._msgrecorder)
+        self._replay = None
+        if args.replay:
+            self._replay = MessageReplay(self, args.replay, not args.fast)
+        self._frames = 0
+
+        self._framebuffer = None
+        if Config.display.backend == 'FRAMEBUFFER':
+            # Nothing is shown through SDL so avoid starting a real video driver
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
 
-        if Config.display.fullscreen:
-            modes = pygame.display.list_modes(0,pygame.FULLSCREEN | pygame.DOUBLEBUF | pygame.HWSURFACE)
+        self._init_pygame()
+
+        # Single buffered display. Only changed regions are copied to the
+        # screen each frame so the display surface must persist between frames
+        if Config.display.backend == 'FRAMEBUFFER':
+            self._framebuffer = FramebufferDisplay(Config.display.framebuffer,
+                                                   Config.display.framebuffersize,
+                                                   Config.display.framebufferdepth,
+                                                   Config.display.framebufferstride)
+            # A minimal mode allows surfaces to be converted. The drawn
+            # softscreen is written to the framebuffer instead
+            pygame.display.set_mode((1,1))
+            screensize = self._framebuffer.size
+            self._screen = None
+        elif Config.display.fullscreen:
+            modes = pygame.display.list_modes(0,pygame.FULLSCREEN | pygame.HWSURFACE)
             if len(modes) == 0:
                 print("No hardware supported fullscreen modes found")
                 quit()
             print ("Available modes: {}".format(modes))
             print ("Selecting screen mode: {}".format(modes[0]))
-            self._screen = pygame.display.set_mode(modes[0],pygame.FULLSCREEN | pygame.DOUBLEBUF | pygame.HWSURFACE)
+            self._screen = pygame.display.set_mode(modes[0],pygame.FULLSCREEN | pygame.HWSURFACE)
         else:
             if Config.display.size is None:
                 print("Window mode requires a size setting in configuration")
                 quit()
-            self._screen = pygame.display.set_mode(Config.display.size,pygame.DOUBLEBUF | pygame.HWSURFACE)
-        
-        screensize = self._screen.get_size()
+            self._screen = pygame.display.set_mode(Config.display.size,pygame.HWSURFACE)
+
+        if self._screen is not None:
+            screensize = self._screen.get_size()
+        self._rotate = None
         if Config.display.rotate90:
             self._softscreen = pygame.Surface((screensize[1],screensize[0])).convert()
+            if self._screen is None:
+                # Rotated image is kept for the framebuffer to copy from
+                self._rotate = RotateStage(self._softscreen, pygame.Surface(screensize).convert())
+            else:
+                self._rotate = RotateStage(self._softscreen, self._screen)
+        elif self._screen is not None and Config.display.directrender:
+            # Windows are composed straight onto the display surface
+            self._softscreen = self._screen
         else:
             self._softscreen = pygame.Surface(screensize).convert()
+        EinkRefresh.configure(Config.eink, screensize)
         self._quit = False
         self._framerate = Config.system.framerate
-        self._subscribe_message(self, MSG_APP_FRAMERATE, None, self._change_framerate)
-        self._sys = System(self)
+        self._frame_t = 0
+        # The main loop sleeps until woken by writing to this pipe
+        self._mainthread = threading.current_thread()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._sys = System(self, screensize, self._replay is not None)
+        self._governor = FramerateGovernor(self, Config.system.framerate,
+                                           Config.system.idleframerate,
+                                           Config.system.idletimeout,
+                                           Config.system.framebudget,
+                                           Config.system.governor)
+        self._subscribe_message(self, MSG_APP_FRAMERATE, FRAMERATE_SET, self._change_framerate)
         self._wnd = SystemWindow(self, self._softscreen)
         self._wnd.focused = True
 
+        # Other processes can post and subscribe to messages over a socket
+        self._msgserver = None
+        if Config.system.messagesocket:
+            self._msgserver = MessageServer(self, Config.system.messagesocket)
+
     def _init_pygame(self):
         pygame.init()
         # Close mixer to prevent 100% CPU
@@ -193,42 +292,149 @@ class App(MessageQueue):
         pygame.mouse.set_visible(False)
 
     def _change_framerate(self, id, context, fr):
-        if fr is None:
-            self._framerate = Config.system.framerate
+        # Follow the rate set by the governor
+        self._framerate = fr
+
+    def post_message(self, msgid, context, message):
+        MessageQueue.post_message(self, msgid, context, message)
+        # Messages from other threads need a new frame to dispatch them. Messages
+        # from the main thread are dispatched this frame or set the next frame time
+        if threading.current_thread() is not self._mainthread:
+            self.wakeup()
+
+    def wakeup(self):
+        'Wake the main loop to process a frame'
+        try:
+            os.write(self._wake_w, b'\0')
+        except (BlockingIOError, OSError):
+            # Pipe full so already waking
+            pass
+
+    def _next_frame_time(self):
+        'Earliest time anything needs processing'
+        if self.pending:
+            # Messages posted after dispatch this frame
+            return 0
+        t = min(self._sys.next_work_time(), self._wnd.next_work_time())
+        refresh_t = EinkRefresh.next_time()
+        if refresh_t is not None:
+            t = min(t, refresh_t)
+        if self._replay:
+            replay_t = self._replay.next_time()
+            if replay_t is not None:
+                t = min(t, replay_t)
+        if self._msgrecorder:
+            record_t = self._msgrecorder.next_time()
+            if record_t is not None:
+                t = min(t, record_t)
+        if self._wnd.app_running:
+            # Running apps are given frames at their framerate
+            if self._framerate:
+                t = min(t, self._frame_t + 1.0/self._framerate)
+            else:
+                t = 0
+        return t
+
+    def _wait(self, until):
+        'Sleep until the given time, input or a wakeup'
+        timeout = max(0, until - time.time())
+        fds = [self._wake_r] + self._sys.input_fds()
+        r, w, x = select.select(fds, [], [], timeout)
+        if self._wake_r in r:
+            try:
+                while os.read(self._wake_r, 64):
+                    pass
+            except (BlockingIOError, OSError):
+                pass
+
+    def _update_screen(self):
+        'Copy changed regions of the softscreen to the display. Returns True if anything changed'
+        rects = self._wnd.pop_damage()
+        if not rects:
+            # Nothing changed this frame
+            return False
+        if self._rotate:
+            rects = self._rotate.update(rects)
+        elif self._screen is not None and self._softscreen is not self._screen:
+            for rect in rects:
+                self._screen.blit(self._softscreen, rect, rect)
+
+        if self._framebuffer:
+            if self._rotate:
+                self._framebuffer.update(self._rotate.target, rects)
+            else:
+                self._framebuffer.update(self._softscreen, rects)
         else:
-            self._framerate = fr
+            pygame.display.update(rects)
+        EinkRefresh.add_damage(rects)
+        return True
 
     def _quitapp(self):
         print("Quitting...")
         self._quit = True
         self._sys.close()
+        if self._msgrecorder:
+            self.set_recorder(None)
+            self._msgrecorder.close()
+        if self._msgserver:
+            self._msgserver.close()
+        if self._framebuffer:
+            self._framebuffer.close()
         pygame.quit()
         
+    def _replayfinished(self):
+        elapsed = time.time() - self._run_t
+        print("Replayed {} messages in {} frames, {:.2f} sec, {:.1f} FPS".format(
+            self._replay.count, self._frames, elapsed, self._frames / max(elapsed, 0.001)))
+        self._quitapp()
+
     def run(self):
+        self._run_t = time.time()
+        try:
+            self._run()
+        finally:
+            if self._msgrecorder:
+                # Keep the end of the recording if the loop ends on an error
+                self._msgrecorder.flush()
+
+    def _run(self):
         while not self._quit:
             try:
+                self._frame_t = time.time()
+                self._frames += 1
                 self._sys.do_work()
+                if self._replay:
+                    self._replay.work()
+                # Deliver input and system messages before windows do their work
+                self.dispatch_messages()
+                if self._msgserver:
+                    # Send messages subscribed to by other processes in one write each
+                    self._msgserver.flush()
                 self._wnd.do_work()
-                if Config.display.rotate90:
-                    newsoftscreen = pygame.transform.rotate(self._softscreen,90)
-                    self._screen.blit(newsoftscreen,(0,0))
-                else:
-                    self._screen.blit(self._softscreen, (0,0))      
-                pygame.display.flip()
-                if self._framerate:
-                    self._clock.tick(self._framerate)
+                damaged = self._update_screen()
+                EinkRefresh.work()
+                if self._msgrecorder:
+                    self._msgrecorder.work()
+                self._governor.frame_done(time.time() - self._frame_t, damaged)
+                if self._replay and self._replay.finished and not self.pending:
+                    self._replayfinished()
+                    break
+                self._wait(self._next_frame_time())
             except KeyboardInterrupt:
                 self._quitapp()
 
 def sigkill(a,b):
-    self._quitapp()
-    quit()
+    # Quit from the main loop as if interrupted
+    raise KeyboardInterrupt()
     
 # Run the app
 if __name__ == '__main__':
     signal.signal(signal.SIGTERM, sigkill)
     parser = argparse.ArgumentParser()
     parser.add_argument('config', type=str, help='config filename', metavar='File')
+    parser.add_argument('--record', type=str, help='record input and system messages to a file', metavar='File')
+    parser.add_argument('--replay', type=str, help='replay recorded messages instead of reading input devices', metavar='File')
+    parser.add_argument('--fast', action='store_true', help='replay as fast as possible rather than in real time')
     args = parser.parse_args()
     myapp = App(args)
     myapp.run()
@@ -1,116 +1,564 @@
-#    Class objects to implement Subject and Observer patterns for Python applications
-#    Copyright (C) 2018  Aidan Holmes
-#
-#    This program is free software: you can redistribute it and/or modify
-#    it under the terms of the GNU General Public License as published by
-#    the Free Software Foundation, either version 3 of the License, or
-#    (at your option) any later version.
-#
-#    This program is distributed in the hope that it will be useful,
-#    but WITHOUT ANY WARRANTY; without even the implied warranty of
-#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-#    GNU General Public License for more details.
-#
-#    You should have received a copy of the GNU General Public License
-#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
-#
-#    Email - aholmes@orbitalfruit.co.uk
-
-class AppPublisher(object):
-        def __init__(self, messagequeue=None):
-                self.message_queue = messagequeue
-
-        def notify_subscription(self, msgid, context):
-                pass
-
-        def register_message(self, msgid):
-                'Thin wrapper to call message queue'
-                if self.message_queue is not None:
-                        return self.message_queue.register_message(self, msgid)
-
-        def remove_message(self,msgid):
-                'Thin wrapper to unregister a message in the queue'
-                if self.message_queue is not None:
-                        return self.message_queue.remove_message(self, msgid)
-		
-class AppSubscriber(object):
-        def __init__(self, messagequeue=None):
-                self.message_queue = messagequeue
-
-        def subscribe_message(self, msgid, context, callback):
-                'Thin wrapper to subscribe to a message in the queue'
-                if self.message_queue is not None:
-                        self.message_queue._subscribe_message(self, msgid, context, callback)
-
-        def unsubscribe_message(self, msgid):
-                'Thin wrapper to unsubscribe to a message in the queue'
-                if self.message_queue is not None:
-                        while self.message_queue._unsubscribe_message(self, msgid): pass
-
-class MessageQueue(object):
-        def __init__(self):
-                # Array of subjects associated with the message ID
-                self._subjectreg = {}
-                # Subscription tuple array per message ID of (observer, context, callback)
-                self._subscriptions = {}
-
-        def register_message(self, subject, msgid):
-                'Register a subject for a message ID. More than one subject can listen on a message ID'
-                # Create a new list to store the subject object for a new message identifier
-                if msgid not in self._subjectreg:
-                        self._subjectreg[msgid] = []
-
-                # Only add the subject once for a message
-                if subject not in self._subjectreg[msgid]:
-                        self._subjectreg[msgid].append(subject)
-                        # Are there subscriptions already made? Call the notification
-                        if msgid in self._subscriptions:
-                                for subs in self._subscriptions[msgid]:
-                                        _notify_subject_registration(msgid, subs[1])
-                        return True
-                # return False if the message was already registered
-                return False
-
-        def remove_message(self, subject, msgid):
-                'Remove a subject handler for a message ID'
-                if msgid in self._subjectreg:
-                        if subject in self._subjectreg[msgid]:
-                                self._subjectreg[msgid].remove(subject)
-                                return True
-                # returns False if the message wasn't there to be removed
-                return False
-
-        def _subscribe_message(self, observer, msgid, context, callback):
-                'Internal queue function for observers to subscribe to messages'
-                if msgid not in self._subscriptions:
-                        self._subscriptions[msgid] = []
-                # Note that duplicates could be entered by a subscriber! No checks are made
-                self._subscriptions[msgid].append((observer, context, callback))
-                # Notify the subject of the new subscriber
-                self._notify_subject_registration(msgid, context)
-
-        def _notify_subject_registration(self, msgid, context):
-                'Function to notify all subjects registered to a message that an observer has registered'
-                if msgid in self._subjectreg:
-                        for subject in self._subjectreg[msgid]:
-                                # send the notification to the subject
-                                subject.notify_subscription(msgid, context)
-
-        def _unsubscribe_message(self, observer, msgid):
-                'Internal queue function to remove an observer from a message ID and stop listening'
-                if msgid in self._subscriptions:
-                        for sub_index in range(len(self._subscriptions[msgid])):
-                                # if the observer is in the array then delete just once and quit the loop
-                                if self._subscriptions[sub_index][0] == observer:
-                                        self._subscriptions.pop(sub_index)
-                                        return True
-                # Nothing removed
-                return False
-        
-        def post_message(self, msgid, context, message):
-                'Post a message to the message queue for observers'
-                if msgid in self._subscriptions:
-                        for registration in self._subscriptions[msgid]:
-                                registration[2](msgid, context, message)
-			
-	
+#    Class objects to implement Subject and Observer patterns for Python applications
+#    Copyright (C) 2018  Aidan Holmes
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Email - aholmes@orbitalfruit.co.uk
+
+from collections import deque
+from threading import Thread, Event, Lock, RLock
+from itertools import count
+from bisect import bisect_left
+import weakref
+import time
+
+class AppPublisher(object):
+        def __init__(self, messagequeue=None):
+                self.message_queue = messagequeue
+
+        def notify_subscription(self, msgid, context):
+                pass
+
+        def register_message(self, msgid):
+                'Thin wrapper to call message queue'
+                if self.message_queue is not None:
+                        return self.message_queue.register_message(self, msgid)
+
+        def remove_message(self,msgid):
+                'Thin wrapper to unregister a message in the queue'
+                if self.message_queue is not None:
+                        return self.message_queue.remove_message(self, msgid)
+		
+class AppSubscriber(object):
+        def __init__(self, messagequeue=None):
+                self.message_queue = messagequeue
+
+        def subscribe_message(self, msgid, context, callback, threaded=False):
+                'Thin wrapper to subscribe to a message in the queue. A context of None receives all contexts. Returns a handle'
+                if self.message_queue is not None:
+                        return self.message_queue._subscribe_message(self, msgid, context, callback, threaded)
+
+        def unsubscribe_message(self, msgid):
+                'Thin wrapper to unsubscribe to a message in the queue'
+                if self.message_queue is not None:
+                        self.message_queue._unsubscribe_message(self, msgid)
+
+        def unsubscribe(self, handle):
+                'Thin wrapper to remove one subscription by the handle returned from subscribe_message'
+                if self.message_queue is not None:
+                        return self.message_queue.unsubscribe(handle)
+
+        def unsubscribe_all(self):
+                'Thin wrapper to remove all subscriptions of this subscriber'
+                if self.message_queue is not None:
+                        self.message_queue._unsubscribe_observer(self)
+
+class DeliveryThread(Thread):
+        'Calls a subscriber callback from its own thread so a slow subscriber cannot hold up dispatch'
+        # Most messages waiting for the callback. The oldest are dropped when full
+        QUEUE_LIMIT = 256
+        def __init__(self, callback):
+                Thread.__init__(self, daemon=True)
+                self.callback = callback
+                self._queue = deque(maxlen=DeliveryThread.QUEUE_LIMIT)
+                self._ready = Event()
+                self._closed = False
+                self.start()
+
+        def __call__(self, msgid, context, message):
+                'Queue a message for the callback. Returns False if the oldest waiting message was dropped for it'
+                full = len(self._queue) == self._queue.maxlen
+                self._queue.append((msgid, context, message))
+                self._ready.set()
+                return not full
+
+        def close(self):
+                'Stop the thread once queued messages are delivered'
+                self._closed = True
+                self._ready.set()
+
+        def run(self):
+                while True:
+                        self._ready.wait()
+                        self._ready.clear()
+                        while self._queue:
+                                msgid, context, message = self._queue.popleft()
+                                try:
+                                        self.callback(msgid, context, message)
+                                except Exception as e:
+                                        # Keep delivering later messages
+                                        print("DEBUG - threaded callback failed for message {}: {}".format(msgid, e))
+                        if self._closed:
+                                return
+
+class Subscription(object):
+        'A callback subscribed to a message ID. Observers and bound method callbacks are weak references'
+        def __init__(self, handle, observer, msgid, context, callback, threaded=False):
+                self.handle = handle
+                self.msgid = msgid
+                self.context = context
+                self._observer = weakref.ref(observer)
+                if hasattr(callback, '__self__') and hasattr(callback, '__func__'):
+                        self._callback = weakref.WeakMethod(callback)
+                        self._function = None
+                        # Identity of the callback without keeping a reference
+                        self.key = (msgid, id(observer), context, id(callback.__self__), id(callback.__func__))
+                else:
+                        self._callback = None
+                        self._function = callback
+                        self.key = (msgid, id(observer), context, id(callback))
+                self.name = getattr(callback, '__qualname__', repr(callback))
+                # MessageStats to record call times in, if collecting
+                self.stats = None
+                self.thread = None
+                if threaded:
+                        self.thread = DeliveryThread(self.call)
+
+        @property
+        def observer(self):
+                return self._observer()
+
+        @property
+        def callback(self):
+                'Function to call or None if the object it belongs to has gone'
+                if self._callback is not None:
+                        return self._callback()
+                return self._function
+
+        def call(self, msgid, context, message):
+                callback = self.callback
+                if callback is not None:
+                        stats = self.stats
+                        if stats is None:
+                                callback(msgid, context, message)
+                        else:
+                                start_t = time.perf_counter()
+                                callback(msgid, context, message)
+                                stats.record(self, time.perf_counter() - start_t)
+
+        def deliver(self, msgid, context, message):
+                if self.thread is not None:
+                        if not self.thread(msgid, context, message):
+                                stats = self.stats
+                                if stats is not None:
+                                        stats.count(stats.dropped, msgid)
+                else:
+                        self.call(msgid, context, message)
+
+        def close(self):
+                if self.thread is not None:
+                        self.thread.close()
+                        self.thread = None
+
+class CallbackStats(object):
+        'Call count and histogram of call times for a subscription'
+        # Upper bounds in seconds of histogram buckets. The last bucket is anything slower
+        BOUNDS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+        def __init__(self, name, msgid):
+                self.name = name
+                self.msgid = msgid
+                self.calls = 0
+                self.total = 0.0
+                self.max = 0.0
+                self.overbudget = 0
+                self.histogram = [0] * (len(CallbackStats.BOUNDS) + 1)
+
+        @property
+        def mean(self):
+                if not self.calls:
+                        return 0.0
+                return self.total / self.calls
+
+        def record(self, t):
+                self.calls += 1
+                self.total += t
+                if t > self.max:
+                        self.max = t
+                self.histogram[bisect_left(CallbackStats.BOUNDS, t)] += 1
+
+class MessageStats(object):
+        'Counts of posted, delivered and dropped messages per message ID and times of each callback'
+        def __init__(self, budget=None, interval=None, names=None):
+                # Seconds a callback can take before it is reported as slow
+                self.budget = budget
+                # Seconds between printed summaries. None to not print
+                self.interval = interval
+                # Printable names of message IDs
+                self.names = names or {}
+                self.reset()
+
+        def reset(self):
+                self.posted = {}
+                self.delivered = {}
+                self.dropped = {}
+                # Messages skipped because a later message replaced them
+                self.merged = {}
+                # CallbackStats by subscription handle
+                self.callbacks = {}
+                self._summary_t = time.time()
+                self._summary_posted = {}
+
+        def count(self, table, msgid, n=1):
+                table[msgid] = table.get(msgid, 0) + n
+
+        def record(self, sub, t):
+                'Record the time a subscription callback took'
+                stats = self.callbacks.get(sub.handle)
+                if stats is None:
+                        stats = self.callbacks[sub.handle] = CallbackStats(sub.name, sub.msgid)
+                stats.record(t)
+                self.count(self.delivered, sub.msgid)
+                if self.budget is not None and t > self.budget:
+                        stats.overbudget += 1
+                        if stats.overbudget == 1:
+                                print("DEBUG - {} took {:.1f} ms for {}, over budget of {:.1f} ms".format(
+                                        sub.name, t * 1000, self.name(sub.msgid), self.budget * 1000))
+
+        def name(self, msgid):
+                return self.names.get(msgid, str(msgid))
+
+        def slow_callbacks(self):
+                'CallbackStats of callbacks which went over budget, slowest first'
+                slow = [stats for stats in self.callbacks.values() if stats.overbudget]
+                return sorted(slow, key=lambda stats: stats.max, reverse=True)
+
+        def summary(self):
+                'Text summary of message counts and callback times'
+                t = time.time()
+                period = max(t - self._summary_t, 0.001)
+                lines = ["Message queue summary over {:.0f} sec".format(period)]
+                for msgid in sorted(self.posted, key=str):
+                        lines.append("  {}: posted {} ({:.1f}/sec), delivered {}, dropped {}, merged {}".format(
+                                self.name(msgid), self.posted[msgid],
+                                (self.posted[msgid] - self._summary_posted.get(msgid, 0)) / period,
+                                self.delivered.get(msgid, 0), self.dropped.get(msgid, 0), self.merged.get(msgid, 0)))
+                for stats in sorted(self.callbacks.values(), key=lambda stats: stats.total, reverse=True):
+                        lines.append("  {} on {}: {} calls, mean {:.2f} ms, max {:.2f} ms, over budget {}".format(
+                                stats.name, self.name(stats.msgid), stats.calls, stats.mean * 1000,
+                                stats.max * 1000, stats.overbudget))
+                self._summary_t = t
+                self._summary_posted = dict(self.posted)
+                return '\n'.join(lines)
+
+        def work(self):
+                'Print a summary when the interval has passed'
+                if self.interval and time.time() >= self._summary_t + self.interval:
+                        print(self.summary())
+
+class MessageQueue(object):
+        # Most messages to deliver in one call to dispatch_messages
+        BATCH_SIZE = 256
+        # Overflow policies when the queue is at its limit
+        DROP_OLDEST = 'drop oldest'
+        MERGE = 'merge'
+        def __init__(self):
+                # Array of subjects associated with the message ID
+                self._subjectreg = {}
+                # Subscriptions by handle for each message ID, in subscription order
+                self._subscriptions = {}
+                # Subscriptions by handle, by observer and by callback identity
+                self._handles = {}
+                self._observers = {}
+                self._keys = {}
+                # Dispatch table of message ID to context to the tuple of subscriptions
+                # for that context and all contexts. Built on first post and cleared for
+                # a message ID when its subscriptions change
+                self._dispatch = {}
+                self._nexthandle = count(1)
+                # Subscriptions can be removed by garbage collection in any thread
+                self._reglock = RLock()
+                # Posted messages waiting for dispatch. Appending to a deque is
+                # thread safe so posting doesn't need a lock
+                self._queue = deque()
+                # Lock taken to remove messages, either to dispatch or when full
+                self._queuelock = Lock()
+                self._limit = None
+                self._overflow = MessageQueue.MERGE
+                # Functions per message ID which return True if a queued message
+                # is replaced by the message after it
+                self._coalesce = {}
+                self._dropped = 0
+                self._stats = None
+                self._recorder = None
+
+        def set_recorder(self, recorder):
+                'Pass every posted message to recorder.record. None to stop recording'
+                self._recorder = recorder
+
+        def enable_stats(self, budget=None, interval=None, names=None):
+                'Start counting messages and timing callbacks. Returns the MessageStats'
+                self._reglock.acquire()
+                try:
+                        self._stats = MessageStats(budget, interval, names)
+                        for sub in self._handles.values():
+                                sub.stats = self._stats
+                finally:
+                        self._reglock.release()
+                return self._stats
+
+        def disable_stats(self):
+                self._reglock.acquire()
+                try:
+                        self._stats = None
+                        for sub in self._handles.values():
+                                sub.stats = None
+                finally:
+                        self._reglock.release()
+
+        @property
+        def stats(self):
+                'MessageStats if enabled, otherwise None'
+                return self._stats
+
+        def set_queue_limit(self, limit, overflow=None):
+                'Limit the number of queued messages. None for no limit. Overflow is DROP_OLDEST or MERGE'
+                self._limit = limit
+                if overflow is not None:
+                        if overflow not in (MessageQueue.DROP_OLDEST, MessageQueue.MERGE):
+                                raise ValueError("Unknown overflow policy {}".format(overflow))
+                        self._overflow = overflow
+
+        def set_coalesce(self, msgid, replaced):
+                'Merge queued messages. replaced(old, new) returns True if message old is not needed when followed by new'
+                if replaced is None:
+                        self._coalesce.pop(msgid, None)
+                else:
+                        self._coalesce[msgid] = replaced
+
+        @property
+        def dropped(self):
+                'Number of messages dropped from a full queue'
+                return self._dropped
+
+        def register_message(self, subject, msgid):
+                'Register a subject for a message ID. More than one subject can listen on a message ID'
+                # Create a new list to store the subject object for a new message identifier
+                if msgid not in self._subjectreg:
+                        self._subjectreg[msgid] = []
+
+                # Only add the subject once for a message
+                if subject not in self._subjectreg[msgid]:
+                        self._subjectreg[msgid].append(subject)
+                        # Are there subscriptions already made? Call the notification
+                        if msgid in self._subscriptions:
+                                for sub in list(self._subscriptions[msgid].values()):
+                                        subject.notify_subscription(msgid, sub.context)
+                        return True
+                # return False if the message was already registered
+                return False
+
+        def remove_message(self, subject, msgid):
+                'Remove a subject handler for a message ID'
+                if msgid in self._subjectreg:
+                        if subject in self._subjectreg[msgid]:
+                                self._subjectreg[msgid].remove(subject)
+                                return True
+                # returns False if the message wasn't there to be removed
+                return False
+
+        def _subscribe_message(self, observer, msgid, context, callback, threaded=False):
+                'Internal queue function for observers to subscribe to messages. Returns a handle to unsubscribe'
+                self._reglock.acquire()
+                try:
+                        sub = Subscription(next(self._nexthandle), observer, msgid, context, callback, threaded)
+                        if sub.key in self._keys:
+                                # Already subscribed. Don't call twice
+                                sub.close()
+                                return self._keys[sub.key]
+                        oid = id(observer)
+                        if oid not in self._observers:
+                                # Remove subscriptions when the observer is deleted
+                                ref = weakref.ref(observer, lambda ref, oid=oid: self._observer_deleted(oid))
+                                self._observers[oid] = (ref, {})
+                        self._observers[oid][1][sub.handle] = sub
+                        self._subscriptions.setdefault(msgid, {})[sub.handle] = sub
+                        sub.stats = self._stats
+                        self._handles[sub.handle] = sub
+                        self._keys[sub.key] = sub.handle
+                        self._dispatch.pop(msgid, None)
+                finally:
+                        self._reglock.release()
+                # Notify the subject of the new subscriber
+                self._notify_subject_registration(msgid, context)
+                return sub.handle
+
+        def _notify_subject_registration(self, msgid, context):
+                'Function to notify all subjects registered to a message that an observer has registered'
+                if msgid in self._subjectreg:
+                        for subject in self._subjectreg[msgid]:
+                                # send the notification to the subject
+                                subject.notify_subscription(msgid, context)
+
+        def unsubscribe(self, handle):
+                'Remove a subscription by handle. Returns False if it was not subscribed'
+                self._reglock.acquire()
+                try:
+                        sub = self._handles.pop(handle, None)
+                        if sub is None:
+                                return False
+                        del self._subscriptions[sub.msgid][handle]
+                        if not self._subscriptions[sub.msgid]:
+                                del self._subscriptions[sub.msgid]
+                        del self._keys[sub.key]
+                        oid = sub.key[1]
+                        if oid in self._observers:
+                                self._observers[oid][1].pop(handle, None)
+                                if not self._observers[oid][1]:
+                                        del self._observers[oid]
+                        self._dispatch.pop(sub.msgid, None)
+                        sub.close()
+                        return True
+                finally:
+                        self._reglock.release()
+
+        def _unsubscribe_message(self, observer, msgid):
+                'Internal queue function to remove an observer from a message ID and stop listening'
+                self._reglock.acquire()
+                try:
+                        entry = self._observers.get(id(observer))
+                        if entry is None:
+                                return False
+                        handles = [sub.handle for sub in entry[1].values() if sub.msgid == msgid]
+                        for handle in handles:
+                                self.unsubscribe(handle)
+                        return len(handles) > 0
+                finally:
+                        self._reglock.release()
+
+        def _unsubscribe_observer(self, observer):
+                'Remove all subscriptions of an observer'
+                self._reglock.acquire()
+                try:
+                        entry = self._observers.get(id(observer))
+                        if entry is not None and entry[0]() is observer:
+                                self._observer_deleted(id(observer))
+                finally:
+                        self._reglock.release()
+
+        def _observer_deleted(self, oid):
+                self._reglock.acquire()
+                try:
+                        entry = self._observers.get(oid)
+                        if entry is not None:
+                                for handle in list(entry[1]):
+                                        self.unsubscribe(handle)
+                finally:
+                        self._reglock.release()
+
+        @property
+        def subscription_count(self):
+                return len(self._handles)
+
+        def post_message(self, msgid, context, message):
+                'Post a message to the message queue for observers. Can be called from any thread'
+                if self._stats is not None:
+                        self._stats.count(self._stats.posted, msgid)
+                if self._recorder is not None:
+                        self._recorder.record(msgid, context, message)
+                if self._limit and len(self._queue) >= self._limit:
+                        self._make_space()
+                self._queue.append((msgid, context, message))
+
+        def _replaced(self, old, new):
+                'True if queued message old can be dropped because of message new'
+                if old[0] != new[0] or old[1] != new[1]:
+                        return False
+                replaced = self._coalesce.get(old[0])
+                return replaced is not None and replaced(old[2], new[2])
+
+        def _make_space(self):
+                'Remove messages from a full queue'
+                self._queuelock.acquire()
+                try:
+                        if len(self._queue) < self._limit:
+                                # Dispatched while waiting for the lock
+                                return
+                        if self._overflow == MessageQueue.MERGE:
+                                # Take everything queued and put back the messages still needed at the front.
+                                # Messages posted meanwhile are appended after them
+                                queued = []
+                                while self._queue:
+                                        queued.append(self._queue.popleft())
+                                merged = []
+                                for item in queued:
+                                        if merged and self._replaced(merged[-1], item):
+                                                self._message_dropped(merged[-1][0])
+                                                merged[-1] = item
+                                        else:
+                                                merged.append(item)
+                                self._queue.extendleft(reversed(merged))
+                        # Nothing merged or dropping oldest. Lose oldest messages
+                        while len(self._queue) >= self._limit:
+                                self._message_dropped(self._queue.popleft()[0])
+                finally:
+                        self._queuelock.release()
+
+        def _message_dropped(self, msgid):
+                self._dropped += 1
+                if self._stats is not None:
+                        self._stats.count(self._stats.dropped, msgid)
+
+        @property
+        def pending(self):
+                'True if posted messages are waiting for dispatch'
+                return len(self._queue) > 0
+
+        def dispatch_messages(self, limit=None):
+                'Deliver posted messages to observers. Call from the UI thread. Returns the number delivered'
+                if limit is None:
+                        limit = MessageQueue.BATCH_SIZE
+                count = 0
+                # Messages posted by callbacks are delivered in the same batch
+                while self._queue and count < limit:
+                        batch = []
+                        self._queuelock.acquire()
+                        try:
+                                while self._queue and count + len(batch) < limit:
+                                        item = self._queue.popleft()
+                                        # Skip messages replaced by the next one, such as touch moves
+                                        if self._queue and self._replaced(item, self._queue[0]):
+                                                if self._stats is not None:
+                                                        self._stats.count(self._stats.merged, item[0])
+                                                continue
+                                        batch.append(item)
+                        finally:
+                                self._queuelock.release()
+                        for msgid, context, message in batch:
+                                self.send_message(msgid, context, message)
+                        count += len(batch)
+                if self._stats is not None:
+                        self._stats.work()
+                return count
+
+        def _dispatch_entry(self, msgid, context):
+                'Build the subscriptions called for a message ID and context'
+                self._reglock.acquire()
+                try:
+                        subs = tuple(sub for sub in self._subscriptions.get(msgid, {}).values()
+                                     if sub.context is None or sub.context == context)
+                        self._dispatch.setdefault(msgid, {})[context] = subs
+                        return subs
+                finally:
+                        self._reglock.release()
+
+        def send_message(self, msgid, context, message):
+                'Deliver a message to observers straight away on the calling thread'
+                try:
+                        subs = self._dispatch[msgid][context]
+                except KeyError:
+                        subs = self._dispatch_entry(msgid, context)
+                for sub in subs:
+                        sub.deliver(msgid, context, message)
+			
+	
@@ -0,0 +1,170 @@
+# Record messages posted to the message queue to a file and play them back
+#
+# Copyright (C) 2019 Aidan Holmes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Email: aidanholmes@orbitalfruit.co.uk
+
+from msgsocket import encode_frame, decode_value, FRAME_HEADER, FRAME_MESSAGE
+from threading import Lock
+import struct
+import time
+
+# Files start with this and each record is the microseconds since the
+# previous record followed by a message frame as sent by msgsocket
+RECORD_MAGIC = b'PGMR\x02'
+RECORD_DELTA = struct.Struct('<Q')
+
+class MessageRecorder(object):
+    'Writes posted messages to a file. Set on a queue with MessageQueue.set_recorder'
+    # Buffered bytes written to the file in one go
+    WRITE_BYTES = 65536
+    # Longest time in seconds a message is buffered before written to the file
+    FLUSH_SECONDS = 2.0
+    def __init__(self, filename, msgids):
+        self._file = open(filename, 'wb')
+        self._file.write(RECORD_MAGIC)
+        self._msgids = set(msgids)
+        self._buffer = bytearray()
+        self._buffer_t = None
+        self._lock = Lock()
+        self._last_t = time.time()
+        self.count = 0
+
+    def record(self, msgid, context, message):
+        'Add a message to the recording if it is one being recorded. Can be called from any thread'
+        if msgid not in self._msgids:
+            return
+        self._lock.acquire()
+        try:
+            t = time.time()
+            delta = int((t - self._last_t) * 1000000)
+            start = len(self._buffer)
+            self._buffer += RECORD_DELTA.pack(max(0, delta))
+            try:
+                encode_frame(FRAME_MESSAGE, (msgid, context, message), self._buffer)
+            except TypeError as e:
+                del self._buffer[start:]
+                print("DEBUG - cannot record message {}: {}".format(msgid, e))
+                return
+            self._last_t = t
+            if self._buffer_t is None:
+                self._buffer_t = t
+            self.count += 1
+            if len(self._buffer) >= MessageRecorder.WRITE_BYTES:
+                self._write()
+        finally:
+            self._lock.release()
+
+    def _write(self):
+        self._file.write(self._buffer)
+        del self._buffer[:]
+        self._buffer_t = None
+
+    def next_time(self):
+        'Time buffered messages are due to be written. None if nothing is buffered'
+        buffer_t = self._buffer_t
+        if buffer_t is None:
+            return None
+        return buffer_t + MessageRecorder.FLUSH_SECONDS
+
+    def work(self):
+        'Write buffered messages to the file if they have waited long enough'
+        t = self.next_time()
+        if t is not None and t <= time.time():
+            self.flush()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            if self._file.closed:
+                return
+            self._write()
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+def read_recording(filename):
+    'Returns a list of (seconds from start, msgid, context, message) from a recording'
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not data.startswith(RECORD_MAGIC):
+        raise ValueError("{} is not a message recording".format(filename))
+    records = []
+    t = 0.0
+    offset = len(RECORD_MAGIC)
+    while offset + RECORD_DELTA.size + FRAME_HEADER.size <= len(data):
+        delta = RECORD_DELTA.unpack_from(data, offset)[0]
+        offset += RECORD_DELTA.size
+        length, frametype = FRAME_HEADER.unpack_from(data, offset)
+        offset += FRAME_HEADER.size
+        end = offset + length
+        if end > len(data):
+            # Recording was cut short
+            break
+        values = []
+        while offset < end:
+            value, offset = decode_value(data, offset)
+            values.append(value)
+        t += delta / 1000000.0
+        if frametype == FRAME_MESSAGE and len(values) == 3:
+            records.append((t, values[0], values[1], values[2]))
+    return records
+
+class MessageReplay(object):
+    '''Posts recorded messages to a message queue. In real time messages are posted
+    with the recorded timing, otherwise each frame posts the next recorded message'''
+    def __init__(self, mq, filename, realtime=True):
+        self._mq = mq
+        self._records = read_recording(filename)
+        self._index = 0
+        self._realtime = realtime
+        self._start_t = None
+
+    @property
+    def finished(self):
+        return self._index >= len(self._records)
+
+    @property
+    def count(self):
+        return len(self._records)
+
+    def next_time(self):
+        'Time the next message is due. None when finished'
+        if self.finished:
+            return None
+        if not self._realtime or self._start_t is None:
+            return 0
+        return self._start_t + self._records[self._index][0]
+
+    def work(self):
+        'Post messages which are due'
+        if self._start_t is None:
+            self._start_t = time.time()
+        if not self._realtime:
+            if not self.finished:
+                t, msgid, context, message = self._records[self._index]
+                self._index += 1
+                self._mq.post_message(msgid, context, message)
+            return
+        elapsed = time.time() - self._start_t
+        while not self.finished and self._records[self._index][0] <= elapsed:
+            t, msgid, context, message = self._records[self._index]
+            self._index += 1
+            self._mq.post_message(msgid, context, message)
@@ -0,0 +1,450 @@
+# Message queue transport over Unix domain sockets. Lets other processes
+# publish and subscribe to messages of the application manager
+#
+# Copyright (C) 2019 Aidan Holmes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Email: aidanholmes@orbitalfruit.co.uk
+
+from msgqueue import MessageQueue
+from threading import Thread, Lock
+import socket
+import select
+import struct
+import os
+
+# Frames are a header of payload length and frame type followed by the payload
+FRAME_HEADER = struct.Struct('<IB')
+FRAME_MESSAGE = 0       # msgid, context, message
+FRAME_SUBSCRIBE = 1     # msgid
+FRAME_UNSUBSCRIBE = 2   # msgid
+
+# Frames are sent once this many bytes are waiting, or on flush
+BATCH_BYTES = 4096
+# Most bytes waiting to send to a connected process. Messages forwarded to a
+# process which doesn't read them are dropped rather than stall the app
+SEND_LIMIT = 262144
+# Largest frame accepted and deepest nesting of lists, tuples and dicts in a message
+FRAME_LIMIT = 1048576
+NESTING_LIMIT = 32
+
+_LENGTH = struct.Struct('<I')
+_INT8 = struct.Struct('<b')
+_INT32 = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+
+def encode_value(value, buf):
+    'Append a compact binary form of value to bytearray buf'
+    if value is None:
+        buf += b'N'
+    elif value is True:
+        buf += b'T'
+    elif value is False:
+        buf += b'F'
+    elif isinstance(value, int):
+        if -128 <= value < 128:
+            buf += b'b' + _INT8.pack(value)
+        elif -2**31 <= value < 2**31:
+            buf += b'i' + _INT32.pack(value)
+        else:
+            buf += b'q' + _INT64.pack(value)
+    elif isinstance(value, float):
+        buf += b'd' + _FLOAT.pack(value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        buf += b's' + _LENGTH.pack(len(data)) + data
+    elif isinstance(value, (bytes, bytearray)):
+        buf += b'y' + _LENGTH.pack(len(value)) + value
+    elif isinstance(value, (list, tuple)):
+        buf += (b'l' if isinstance(value, list) else b't') + _LENGTH.pack(len(value))
+        for item in value:
+            encode_value(item, buf)
+    elif isinstance(value, dict):
+        buf += b'm' + _LENGTH.pack(len(value))
+        for key, item in value.items():
+            encode_value(key, buf)
+            encode_value(item, buf)
+    else:
+        raise TypeError("Cannot send {} in a message".format(type(value).__name__))
+    return buf
+
+def decode_value(data, offset=0, depth=0):
+    'Read a value written by encode_value. Returns the value and offset after it'
+    if depth > NESTING_LIMIT:
+        raise ValueError("Message values nested more than {} deep".format(NESTING_LIMIT))
+    tag = data[offset:offset+1]
+    offset += 1
+    if tag == b'N':
+        return None, offset
+    elif tag == b'T':
+        return True, offset
+    elif tag == b'F':
+        return False, offset
+    elif tag == b'b':
+        return _INT8.unpack_from(data, offset)[0], offset + _INT8.size
+    elif tag == b'i':
+        return _INT32.unpack_from(data, offset)[0], offset + _INT32.size
+    elif tag == b'q':
+        return _INT64.unpack_from(data, offset)[0], offset + _INT64.size
+    elif tag == b'd':
+        return _FLOAT.unpack_from(data, offset)[0], offset + _FLOAT.size
+    elif tag in (b's', b'y'):
+        length = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        value = bytes(data[offset:offset+length])
+        if tag == b's':
+            value = value.decode('utf-8')
+        return value, offset + length
+    elif tag in (b'l', b't'):
+        length = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        items = []
+        for i in range(length):
+            item, offset = decode_value(data, offset, depth + 1)
+            items.append(item)
+        if tag == b't':
+            items = tuple(items)
+        return items, offset
+    elif tag == b'm':
+        length = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        value = {}
+        for i in range(length):
+            key, offset = decode_value(data, offset, depth + 1)
+            value[key], offset = decode_value(data, offset, depth + 1)
+        return value, offset
+    raise ValueError("Unknown value type {!r} in message".format(tag))
+
+def encode_frame(frametype, values, buf):
+    'Append a frame of values to bytearray buf'
+    start = len(buf)
+    buf += FRAME_HEADER.pack(0, frametype)
+    for value in values:
+        encode_value(value, buf)
+    FRAME_HEADER.pack_into(buf, start, len(buf) - start - FRAME_HEADER.size, frametype)
+    return buf
+
+class FrameReader(object):
+    'Collects received bytes and splits them into frames'
+    def __init__(self):
+        self._data = bytearray()
+
+    def feed(self, data):
+        'Add received data. Returns a list of (frame type, values)'
+        self._data += data
+        frames = []
+        offset = 0
+        while len(self._data) - offset >= FRAME_HEADER.size:
+            length, frametype = FRAME_HEADER.unpack_from(self._data, offset)
+            if length > FRAME_LIMIT:
+                raise ValueError("Frame of {} bytes is over the limit".format(length))
+            end = offset + FRAME_HEADER.size + length
+            if len(self._data) < end:
+                break
+            values = []
+            pos = offset + FRAME_HEADER.size
+            while pos < end:
+                value, pos = decode_value(self._data, pos)
+                values.append(value)
+            frames.append((frametype, values))
+            offset = end
+        del self._data[:offset]
+        return frames
+
+class SocketConnection(object):
+    'Buffered frames to send on a socket'
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+        self._buffer = bytearray()
+        self._lock = Lock()
+
+    @property
+    def waiting(self):
+        'True if frames are waiting to be sent'
+        return len(self._buffer) > 0
+
+    def send_frame(self, frametype, *values):
+        self._lock.acquire()
+        try:
+            encode_frame(frametype, values, self._buffer)
+            full = len(self._buffer) >= BATCH_BYTES
+        finally:
+            self._lock.release()
+        if full:
+            self.flush()
+
+    def flush(self):
+        'Send buffered frames. On a non-blocking socket anything not sent is kept for the next flush'
+        self._lock.acquire()
+        try:
+            while self._buffer:
+                try:
+                    sent = self.sock.send(self._buffer)
+                except BlockingIOError:
+                    break
+                del self._buffer[:sent]
+        finally:
+            self._lock.release()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class RemoteSubscriber(SocketConnection):
+    'Process connected to a MessageServer. Messages it subscribes to are forwarded to it'
+    def __init__(self, mq, sock):
+        SocketConnection.__init__(self, sock)
+        self._mq = mq
+        # Messages not forwarded because the process isn't reading them
+        self.dropped = 0
+
+    def forward(self, msgid, context, message):
+        if len(self._buffer) >= SEND_LIMIT:
+            self.dropped += 1
+            if self.dropped == 1:
+                print("DEBUG - message socket client isn't reading, dropping messages")
+            stats = self._mq.stats
+            if stats is not None:
+                stats.count(stats.dropped, msgid)
+            return
+        try:
+            self.send_frame(FRAME_MESSAGE, msgid, context, message)
+        except TypeError as e:
+            print("DEBUG - cannot forward message {}: {}".format(msgid, e))
+        except OSError:
+            # Connection has gone. Removed by the server thread
+            pass
+
+class MessageServer(object):
+    'Accepts connections on a Unix socket path and joins them to a message queue'
+    def __init__(self, mq, path):
+        self._mq = mq
+        self._path = path
+        self._quit = False
+        self._connections = {}
+        self._lock = Lock()
+        if os.path.exists(path):
+            # Left over from a previous run
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(5)
+        # Wakes the server thread to close
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_w, False)
+        self._thread = Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    @property
+    def connections(self):
+        return len(self._connections)
+
+    def _serve(self):
+        while not self._quit:
+            fds = [self._sock, self._wake_r] + list(self._connections)
+            # Finish sending frames left over when a socket was full
+            waiting = [sock for sock, conn in list(self._connections.items()) if conn.waiting]
+            r, w, x = select.select(fds, waiting, [])
+            for sock in w:
+                conn = self._connections.get(sock)
+                if conn is not None:
+                    try:
+                        conn.flush()
+                    except OSError:
+                        # Removed when the socket reads as closed
+                        pass
+            for sock in r:
+                if sock is self._sock:
+                    conn, addr = self._sock.accept()
+                    # Writes from the UI thread must never wait on the other process
+                    conn.setblocking(False)
+                    self._lock.acquire()
+                    try:
+                        self._connections[conn] = RemoteSubscriber(self._mq, conn)
+                    finally:
+                        self._lock.release()
+                elif sock == self._wake_r:
+                    os.read(self._wake_r, 512)
+                elif sock in self._connections:
+                    self._receive(self._connections[sock])
+
+    def _receive(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._disconnect(conn)
+            return
+        try:
+            frames = conn.reader.feed(data)
+        except Exception as e:
+            # Anything wrong with the data drops only this connection
+            print("DEBUG - bad message frame: {}".format(e))
+            self._disconnect(conn)
+            return
+        for frametype, values in frames:
+            try:
+                self._frame(conn, frametype, values)
+            except Exception as e:
+                # A bad client must not stop the server or the app
+                print("DEBUG - bad message frame: {}".format(e))
+                self._disconnect(conn)
+                return
+
+    @staticmethod
+    def _valid(msgid, context=None):
+        'True if a message ID and context can be used in the message queue'
+        if not isinstance(msgid, int) or isinstance(msgid, bool):
+            return False
+        try:
+            hash(context)
+        except TypeError:
+            return False
+        return True
+
+    def _frame(self, conn, frametype, values):
+        if frametype == FRAME_MESSAGE and len(values) == 3 and self._valid(values[0], values[1]):
+            self._mq.post_message(*values)
+        elif frametype == FRAME_SUBSCRIBE and len(values) == 1 and self._valid(values[0]):
+            # One subscription for all contexts so each message is forwarded once.
+            # The client delivers it to the contexts it subscribed to
+            self._mq._subscribe_message(conn, values[0], None, conn.forward)
+        elif frametype == FRAME_UNSUBSCRIBE and len(values) == 1 and self._valid(values[0]):
+            self._mq._unsubscribe_message(conn, values[0])
+        else:
+            raise ValueError("frame type {} with invalid values {!r}".format(frametype, values))
+
+    def _disconnect(self, conn):
+        self._lock.acquire()
+        try:
+            self._connections.pop(conn.sock, None)
+        finally:
+            self._lock.release()
+        self._mq._unsubscribe_observer(conn)
+        conn.close()
+
+    def flush(self):
+        'Send messages forwarded since the last flush. Call after dispatch'
+        self._lock.acquire()
+        try:
+            connections = list(self._connections.values())
+        finally:
+            self._lock.release()
+        wake = False
+        for conn in connections:
+            try:
+                conn.flush()
+            except OSError:
+                # Removed when the server thread sees the socket close
+                pass
+            wake = wake or conn.waiting
+        if wake:
+            # Server thread sends the rest when the sockets can take it
+            self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            # Already woken
+            pass
+
+    def close(self):
+        self._quit = True
+        self._wake()
+        self._thread.join(2.0)
+        for conn in list(self._connections.values()):
+            self._disconnect(conn)
+        self._sock.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+class MessageClient(MessageQueue):
+    '''Message queue for another process connected to a MessageServer. AppPublisher
+    and AppSubscriber objects use this as they would a local MessageQueue'''
+    def __init__(self, path):
+        MessageQueue.__init__(self)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self._conn = SocketConnection(sock)
+        # Local subscriptions for each message ID subscribed to on the server
+        self._remotecount = {}
+
+    @property
+    def fd(self):
+        'Socket to wait on for messages from the server'
+        return self._conn.sock.fileno()
+
+    def post_message(self, msgid, context, message):
+        'Send a message to the server. It returns to local subscribers through the server'
+        self._conn.send_frame(FRAME_MESSAGE, msgid, context, message)
+
+    def _subscribe_message(self, observer, msgid, context, callback, threaded=False):
+        new = len(self._handles)
+        handle = MessageQueue._subscribe_message(self, observer, msgid, context, callback, threaded)
+        if len(self._handles) == new:
+            # Already subscribed
+            return handle
+        self._remotecount[msgid] = self._remotecount.get(msgid, 0) + 1
+        if self._remotecount[msgid] == 1:
+            # First local subscription for the message
+            self._conn.send_frame(FRAME_SUBSCRIBE, msgid)
+            self._conn.flush()
+        return handle
+
+    def unsubscribe(self, handle):
+        sub = self._handles.get(handle)
+        ret = MessageQueue.unsubscribe(self, handle)
+        if ret and sub is not None:
+            self._remotecount[sub.msgid] -= 1
+            if self._remotecount[sub.msgid] <= 0:
+                # Last local subscription for the message
+                del self._remotecount[sub.msgid]
+                self._conn.send_frame(FRAME_UNSUBSCRIBE, sub.msgid)
+        return ret
+
+    def flush(self):
+        'Send buffered messages to the server'
+        self._conn.flush()
+
+    def poll(self, timeout=None):
+        '''Send buffered messages, wait up to timeout seconds for messages from the
+        server and deliver them. Returns False if the server closed the connection'''
+        self.flush()
+        r, w, x = select.select([self._conn.sock], [], [], timeout)
+        if r:
+            data = self._conn.sock.recv(65536)
+            if not data:
+                return False
+            for frametype, values in self._conn.reader.feed(data):
+                if frametype == FRAME_MESSAGE and len(values) == 3:
+                    MessageQueue.post_message(self, *values)
+        self.dispatch_messages()
+        return True
+
+    def close(self):
+        self.flush()
+        self._conn.close()
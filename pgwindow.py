@@ -19,6 +19,8 @@
 
 import pygame
 import time
+from textcache import TextCache
+from fonts import Fonts
 
 AppInfo = {'iconname':'Default',
            'icon':None,
@@ -74,6 +76,34 @@ class FrameClock(object):
 
         return ret
 
+def merge_rects(rects):
+    'Combine overlapping rects into a shorter list of larger rects'
+    merged = []
+    for rect in rects:
+        rect = rect.copy()
+        i = rect.collidelist(merged)
+        while i >= 0:
+            rect.union_ip(merged.pop(i))
+            i = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+def subtract_rect(rect, cover):
+    'Return the parts of rect not covered by cover as a list of rects'
+    clip = rect.clip(cover)
+    if clip.width == 0 or clip.height == 0:
+        return [rect]
+    pieces = []
+    if clip.top > rect.top:
+        pieces.append(pygame.Rect(rect.left, rect.top, rect.width, clip.top - rect.top))
+    if clip.bottom < rect.bottom:
+        pieces.append(pygame.Rect(rect.left, clip.bottom, rect.width, rect.bottom - clip.bottom))
+    if clip.left > rect.left:
+        pieces.append(pygame.Rect(rect.left, clip.top, clip.left - rect.left, clip.height))
+    if clip.right < rect.right:
+        pieces.append(pygame.Rect(clip.right, clip.top, rect.right - clip.right, clip.height))
+    return pieces
+
 class PygameWnd(object):
     TOP = 0
     BOTTOM = -1
@@ -83,10 +113,14 @@ class PygameWnd(object):
         self._wndpos = None
         self._isdirty = True
         self._invert = False
+        # Cached inverted copy of the surface, used when inverted
+        self._invertsurface = None
         self._ishidden = False
         self._isactive = True # will this wnd accept input?
         self._isfocused = False
         self._children = []
+        # List of rects changed since the last copy_to. Relative to this window
+        self._damage = []
         if rect is not None:
             self._wndpos = rect.copy()
         if screen is not None:
@@ -96,6 +130,8 @@ class PygameWnd(object):
         if rect is not None and screen is None:
             self.createwnd(rect)
         self.parent = None
+        # Nothing has been copied yet so the whole window is new
+        self.damage()
 
     @property
     def screen_position(self):
@@ -116,6 +152,7 @@ class PygameWnd(object):
 
     @position.setter
     def position(self, val):
+        oldpos = self._wndpos.copy()
         if isinstance(val, pygame.Rect):
             self._wndpos = val.copy()
         elif isinstance(val, tuple):
@@ -132,6 +169,12 @@ class PygameWnd(object):
 
         else:
             raise TypeError("Incorrect type for position")
+        if oldpos != self._wndpos:
+            # Uncovers windows below at the old location and
+            # needs copying to the new location
+            if self.parent:
+                self.parent.damage(oldpos)
+            self.damage()
 
     @property
     def hidden(self):
@@ -140,8 +183,13 @@ class PygameWnd(object):
     @hidden.setter
     def hidden(self,val):
         if val:
+            if not self._ishidden and self.parent:
+                # Windows below need copying again
+                self.parent.damage(self._wndpos)
             self._ishidden = True
         else:
+            if self._ishidden:
+                self.damage()
             self._ishidden = False
 
     @property
@@ -171,8 +219,22 @@ class PygameWnd(object):
 
     @invert.setter
     def invert(self, setinvert):
+        if setinvert != self._invert:
+            self.damage()
+        if not setinvert:
+            # Release the cache. Rebuilt when inverted again
+            self._invertsurface = None
         self._invert = setinvert
 
+    @property
+    def opaque(self):
+        'True if the window surface completely covers anything below it'
+        if not self._surface:
+            return False
+        if self._surface.get_flags() & pygame.SRCALPHA:
+            return False
+        return self._surface.get_colorkey() is None and self._surface.get_alpha() is None
+
     def add_child(self, wnd, order=TOP):
         if wnd in self._children:
             # already added
@@ -183,12 +245,16 @@ class PygameWnd(object):
             self._children.insert(order, wnd)
 
         wnd.parent = self
+        # The whole window is new to this parent
+        wnd.damage()
 
         return True
 
     def remove_child(self, wnd):
         try:
             self._children.remove(wnd)
+            # Windows below need copying again
+            self.damage(wnd.position)
             return True
         except ValueError:
             pass
@@ -246,27 +312,115 @@ class PygameWnd(object):
     def createwnd(self, rect):
         self._surface = pygame.Surface((rect.width, rect.height)).convert()
         self._wndpos = rect.copy()
+        self.damage()
+
+    def damage(self, rect=None):
+        'mark a region of the window as changed. Whole window if rect is None'
+        if not self._surface:
+            return
+        bounds = self._surface.get_rect()
+        if rect is None:
+            rect = bounds
+        else:
+            rect = bounds.clip(pygame.Rect(rect))
+        if rect.width > 0 and rect.height > 0:
+            for existing in self._damage:
+                if existing.contains(rect):
+                    # Already damaged
+                    return
+            self._damage.append(rect)
+
+    @property
+    def damaged(self):
+        return len(self._damage) > 0
+
+    def pop_damage(self):
+        'return the merged list of damaged rects and clear them'
+        rects = merge_rects(self._damage)
+        self._damage = []
+        return rects
 
     def draw(self):
         'window self draw. The window should decide when to draw'
         if self._surface:
             self._surface.fill((255,255,255))
+            self.damage()
             
-    def copy_to(self, wnd):
-        'blit window image to surface'
-        if not self._ishidden and self._surface:
-            for child in reversed(self._children):
-                # This could be improved by checking if a window is completely
-                # obscured by other windows and avoid drawing.
-                child.copy_to(self)
-
-            if self._invert:
-                wndcpy = pygame.Surface(self._wndpos.width, self._wndpos.height,0,self._surface)
-                wndcpy.fill((255,255,255))
-                wndcpy.blit(self._surface,(0,0),None,pygame.BLEND_SUB)
-                wnd._surface.blit(wndcpy, self._wndpos)
-            else:
-                wnd._surface.blit(self._surface, self._wndpos)
+    def visible_children(self):
+        'list of (child, visible rects) from bottom to top. Covered children are left out'
+        visible = []
+        # Rects of opaque windows higher in the z-order
+        covers = []
+        for child in self._children:
+            if child.hidden or not child._surface:
+                continue
+            pieces = [child.position]
+            for cover in covers:
+                pieces = [piece for rect in pieces for piece in subtract_rect(rect, cover)]
+                if not pieces:
+                    break
+            if pieces:
+                visible.append((child, pieces))
+            if child.opaque:
+                covers.append(child.position)
+        visible.reverse()
+        return visible
+
+    def compose(self):
+        'copy damaged regions of visible child windows onto this window'
+        for child, pieces in self.visible_children():
+            # Each child also refreshes regions damaged by lower windows
+            child.copy_to(self, self._damage, pieces)
+
+    def _inverted_surface(self, rects):
+        'cached inverted copy of the surface. Only redrawn rects are inverted again'
+        if self._invertsurface is None or self._invertsurface.get_size() != self._surface.get_size():
+            self._invertsurface = self._surface.copy()
+            rects = [self._surface.get_rect()]
+        for rect in rects:
+            self._invertsurface.fill((255,255,255), rect)
+            self._invertsurface.blit(self._surface, rect, rect, pygame.BLEND_SUB)
+        return self._invertsurface
+
+    def copy_to(self, wnd, below=None, visible=None):
+        'blit changed window regions to surface. Returns rects updated in wnd'
+        if self._ishidden or not self._surface:
+            return []
+
+        self.compose()
+
+        # Regions of this window surface which have been redrawn
+        rects = self.pop_damage()
+
+        source = self._surface
+        if self._invert:
+            source = self._inverted_surface(rects)
+
+        # Anything redrawn underneath this window in the parent
+        # needs this window copying over it again
+        if below:
+            self._damage = rects
+            for rect in below:
+                self.damage(rect.move(-self._wndpos.x, -self._wndpos.y))
+            rects = self.pop_damage()
+
+        if not rects:
+            return []
+
+        if visible is not None:
+            # Only copy the parts not covered by other windows. Pieces
+            # don't overlap so neither do the clipped rects
+            pieces = [piece.move(-self._wndpos.x, -self._wndpos.y) for piece in visible]
+            rects = [rect.clip(piece) for rect in rects for piece in pieces
+                     if rect.colliderect(piece)]
+
+        updated = []
+        for rect in rects:
+            dest = rect.move(self._wndpos.topleft)
+            wnd._surface.blit(source, dest, rect)
+            wnd.damage(dest)
+            updated.append(dest)
+        return updated
         
 
 class PygameApp(PygameWnd):
@@ -275,6 +429,10 @@ class PygameApp(PygameWnd):
   
     def do_work(self):
         pass
+
+    def set_framerate(self, fr):
+        'Framerate the app is now given. None if as fast as possible'
+        pass
     
     def touch(self, evt):
         PygameWnd.touch(self,evt)
@@ -292,7 +450,7 @@ class PygameApp(PygameWnd):
 
 class PygameButton(PygameWnd):
     def __init__(self, *arg, **kwargs):
-        self._font = pygame.font.Font(None, 20)
+        self._font = Fonts.get(None, 20)
         self.name = "Button"
         PygameWnd.__init__(self, *arg, **kwargs)
         self.draw()
@@ -309,8 +467,9 @@ class PygameButton(PygameWnd):
                 pygame.draw.rect(self._surface, (225,225,225), self._surface.get_rect(),0)
                 pygame.draw.rect(self._surface, (173,173,173), self._surface.get_rect(),1)
 
-            text = self._font.render(self.name, 1, (10,10,10))
+            text = TextCache.render(self._font, self.name, 1, (10,10,10))
             self._surface.blit(text, text.get_rect(center=self._surface.get_rect().center))
+            self.damage()
 
 class PygameTextWnd(PygameWnd):
     def __init__(self, *arg, **kwargs):
@@ -319,99 +478,140 @@ class PygameTextWnd(PygameWnd):
         self.margin = (0,0)
         self.background = (255,255,255)
         self.lineseparation = 5
+        # Layout position reached by the last update. Text is laid out
+        # from here when more is added
+        self._layout = None
+        self._relayout = True
         
     def add_text(self, text, size, colour, face=None):
         # Support newlines by breaking up text into fragments with newline attribute set
         lines = text.split('\n')
-        font = pygame.font.Font(face, size)
+        font = Fonts.get(face, size)
         for i, line in enumerate(lines):
             newline = True
             if i == len(lines)-1:
                 newline = False
-            self._text.append({"text": line, "colour": colour, "fontobj": font, "newline": newline})
-                
-        self.draw()
+            self._text.append(self._create_fragment(line, colour, font, newline))
+        # Text is laid out on the next update_text or copy_to so
+        # adding several pieces of text only draws once
+
+    def _create_fragment(self, text, colour, fontobj, newline):
+        # Measure and render each word once when added
+        words = []
+        for word in text.split(): # Split the text into separate words
+            word = word + ' ' # use a space to separate
+            (extents_x, extents_y) = fontobj.size(word)
+            words.append({"img": TextCache.render(fontobj, word, 1, colour),
+                          "width": extents_x,
+                          "height": extents_y})
+        return {"text": text, "colour": colour, "fontobj": fontobj, "newline": newline,
+                "words": words,
+                "ascent": fontobj.get_ascent(),
+                "height": fontobj.get_height()}
         
     def clear_text(self):
         self._text = []
-        self.draw()
+        self._relayout = True
 
     def draw(self):
-        self._surface.fill(self.background)
-        if not self.draw_text():
+        self._relayout = True
+        self.update_text()
+
+    def update_text(self):
+        'lay out text added since the last update. Returns False if text exceeds the window'
+        if self._relayout:
+            self._relayout = False
+            self._surface.fill(self.background)
+            self.damage()
+            self._layout = {"fragment": 0,
+                            "cursor_x": self.margin[0],
+                            "cursor_y": self.margin[1],
+                            "max_height": 0,
+                            "max_ascent": 0,
+                            "line": [],
+                            "full": False}
+        layout = self._layout
+        if layout["full"] or layout["fragment"] >= len(self._text):
+            # Nothing new that can be drawn
+            return not layout["full"]
+
+        top = layout["cursor_y"]
+        if len(layout["line"]) > 0:
+            # The unfinished last line is drawn again with the new text
+            # as the baseline can change
+            self._surface.fill(self.background, (0, top, self._wndpos.width, layout["max_height"]))
+
+        fits = self.draw_text()
+        if fits:
+            bottom = layout["cursor_y"] + layout["max_height"]
+        else:
             print ("DEBUG: Text exceeds available window space")
+            bottom = self._wndpos.height
+        self.damage(pygame.Rect(0, top, self._wndpos.width, bottom - top))
+        return fits
 
     def draw_text(self):
-        # Drawing cursor. Remember where the next word image starts
-        cursor_x = self.margin[0]
-        cursor_y = self.margin[1]
-        # Line attributes
-        max_height = 0
-        max_ascent = 0
-        max_descent = 0
-        # Cache of images for a line of text
-        img_line = [] 
+        # Drawing cursor and line attributes are kept in the layout
+        # so drawing continues from the last fragment drawn
+        layout = self._layout
         # A fragment is a string of word(s) with a specific font size, colour and style 
-        for fragment in self._text:
-            fontobj = fragment["fontobj"] # Easy ref for font object
+        while layout["fragment"] < len(self._text):
+            fragment = self._text[layout["fragment"]]
+            layout["fragment"] = layout["fragment"] + 1
             
-            for word in fragment["text"].split(): # Split the text into separate words
-                word = word + ' ' # use a space to separate
-                (extents_x, extents_y) = fontobj.size(word)
-
+            for word in fragment["words"]:
                 # Check that the word fits on the line
-                adv_cursor_x = cursor_x + extents_x
-                if adv_cursor_x + self.margin[0] > self.position.width and len(img_line) > 0:
+                adv_cursor_x = layout["cursor_x"] + word["width"]
+                if adv_cursor_x + self.margin[0] > self._wndpos.width and len(layout["line"]) > 0:
                     # Reached the extents of the image. This is the end of the line
-                    # Blit images
-                    self.blit_line(img_line, max_ascent, cursor_y)
-                    img_line = [] # remove img line cache for a fresh line
-                    # Reset cursor x. Advance cursor y
-                    cursor_x = self.margin[0]
-                    cursor_y = cursor_y + max_height + self.lineseparation
-                    max_height = 0
-                    max_ascent = 0
-                    max_descent = 0
-                    if cursor_y + self.margin[1] > self.position.height:
+                    self.blit_line(layout["line"], layout["max_ascent"], layout["cursor_y"])
+                    self._next_line(layout["max_height"])
+                    if layout["cursor_y"] + self.margin[1] > self._wndpos.height:
                         # run out of room. Quit and soft error
+                        layout["full"] = True
                         return False
+                    adv_cursor_x = layout["cursor_x"] + word["width"]
 
-                # Render the text for this word. Add to list of images for the line
-                img_line.append({"img": fontobj.render(word, 1, fragment["colour"]),
-                                 "ascent": fontobj.get_ascent()})
+                # Add the word image to the list of images for the line
+                layout["line"].append({"img": word["img"], "ascent": fragment["ascent"]})
                 # Advance the x cursor to next work position in the line
-                cursor_x = cursor_x + extents_x
+                layout["cursor_x"] = adv_cursor_x
 
                 # Recalculate extents for this line
-                max_height = max(extents_y, max_height)
-                max_ascent = max(fontobj.get_ascent(), max_ascent)
-                max_descent = max(fontobj.get_descent(), max_descent)
+                layout["max_height"] = max(word["height"], layout["max_height"])
+                layout["max_ascent"] = max(fragment["ascent"], layout["max_ascent"])
                     
             if fragment["newline"]:
                 # This fragment requires a new line following the text
                 # Does this contain text to blit or an empty newline?
-                if len(img_line) > 0:
-                    self.blit_line(img_line, max_ascent, cursor_y)
-                    img_line = []
-                    cursor_y = cursor_y + max_height + self.lineseparation
+                if len(layout["line"]) > 0:
+                    self.blit_line(layout["line"], layout["max_ascent"], layout["cursor_y"])
+                    self._next_line(layout["max_height"])
                 else:
                     # No text. Assume get_height gives a reasonable height without any specified text
-                    cursor_y = cursor_y + fontobj.get_height() + self.lineseparation
-                cursor_x = self.margin[0]
-                max_height = 0
-                max_ascent = 0
-                max_descent = 0
-                if cursor_y + self.margin[1] > self.position.height:
+                    self._next_line(fragment["height"])
+                if layout["cursor_y"] + self.margin[1] > self._wndpos.height:
                     # Cannot fit more lines into window
+                    layout["full"] = True
                     return False
 
-        # Last fragment processed. Print final line
-        if len(img_line) > 0:
-            self.blit_line(img_line, max_ascent, cursor_y)
+        # Last fragment processed. Print final line. The line is kept
+        # in the layout as more text can be added to it
+        if len(layout["line"]) > 0:
+            self.blit_line(layout["line"], layout["max_ascent"], layout["cursor_y"])
             
         # All processed within the window
         return True 
 
+    def _next_line(self, height):
+        # Reset cursor x. Advance cursor y
+        layout = self._layout
+        layout["line"] = []
+        layout["cursor_x"] = self.margin[0]
+        layout["cursor_y"] = layout["cursor_y"] + height + self.lineseparation
+        layout["max_height"] = 0
+        layout["max_ascent"] = 0
+
     def blit_line(self, img_line, max_ascent, cursor_y):
         tmp_x = self.margin[0]
         for img in img_line:
@@ -421,3 +621,8 @@ class PygameTextWnd(PygameWnd):
             self._surface.blit(img["img"], (tmp_x, cursor_y + height_diff))
             # Advance temp x cursor to draw line
             tmp_x = tmp_x + img["img"].get_width()
+
+    def copy_to(self, wnd, below=None, visible=None):
+        # Lay out any text added since the last copy
+        self.update_text()
+        return PygameWnd.copy_to(self, wnd, below, visible)
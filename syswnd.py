@@ -27,16 +27,34 @@ from os.path import join
 from launcher import PygameLauncher
 from msgqueue import AppPublisher, AppSubscriber, MessageQueue
 from pgwindow import PygameWnd
+from textcache import TextCache
+from fonts import Fonts
+
+class HeaderSegment(object):
+  'A field of the header bar. Drawn again only when its text or position changes'
+  def __init__(self, icon=None):
+    self.icon = icon
+    # Text to show. Segment is not shown if None
+    self.text = None
+    # Rect of the segment on the header and the text and rect last drawn
+    self.rect = None
+    self.drawntext = None
+    self.drawnrect = None
+
+  @property
+  def changed(self):
+    return self.text != self.drawntext or self.rect != self.drawnrect
 
 class HeaderBar(AppSubscriber, PygameWnd):
   def __init__(self, mq, *arg, **kwargs):
     PygameWnd.__init__(self, *arg, **kwargs)
     AppSubscriber.__init__(self,mq)
 
-    self.subscribe_message(MSG_SYS_BATTERY, None, self._battevent)
+    self.subscribe_message(MSG_SYS_BATTERY, BATT_CAPACITY, self._battcapacityevent)
+    self.subscribe_message(MSG_SYS_BATTERY, BATT_STATUS, self._battstatusevent)
     self.subscribe_message(MSG_SYS_NETWORK, None, self._networkevent)
 
-    self._font = pygame.font.Font(None, Config.statusbar.fontsize)
+    self._font = Fonts.get(None, Config.statusbar.fontsize)
     self._batteryicon = pygame.image.load(join(Config.system.resourcedir,Config.statusbar.battery_icon))
     self._batteryicon = pygame.transform.scale(self._batteryicon, Config.statusbar.battery_icon_size)
     self._batterycharge = None
@@ -59,86 +77,142 @@ class HeaderBar(AppSubscriber, PygameWnd):
     self._background = Config.statusbar.background
     self._headerspacing = Config.statusbar.spacing
 
+    self._battseg = HeaderSegment(self._batteryicon)
+    self._memseg = HeaderSegment(self._memicon)
+    self._cpuseg = HeaderSegment(self._cpuicon)
+    self._ipseg = HeaderSegment()
+    self._activityseg = HeaderSegment()
+    self._segments = [self._battseg, self._memseg, self._cpuseg, self._ipseg, self._activityseg]
+
+  def next_work_time(self):
+    'Time of the next blink or poll'
+    return min(self._blink_t + 1, self._mem_poll_t + self._mem_poll)
+
   def work(self):
     t = time.time()
-    redraw = False
+    update = False
     if t > self._blink_t + 1:
       self._blink_t = t
       self._blink_on = not self._blink_on
-      redraw = True
+      update = True
     if t > self._mem_poll_t + self._mem_poll:
       self._mem_poll_t = t
       self._memory = psutil.virtual_memory()
       self._cpu = psutil.cpu_percent(None,False)
-      redraw = True
+      update = True
 
-    if redraw:
-      self.draw()
-
-  def draw(self):
-    # Clear background of header
-    self._surface.fill((255,255,255))
-    screenrect = self._surface.get_rect()
+    if update:
+      self.update_segments()
 
+  def _segment_text(self):
     txtcharge = ''
     if self._batterystatus == 'Charging':
       txtcharge = '+'
     elif self._batterystatus == 'Discharging':
       txtcharge = '-'
 
-    # Draw battery status
     if self._batterycharge is not None:
-      text = self._font.render(self._batterycharge + txtcharge + '%', 1, (10,10,10))
-      pos = text.get_rect()
-      pos.right = self._wndpos.width
-      pos.centery = screenrect.centery
-      self._surface.blit(text,pos)
-      pos = self._batteryicon.get_rect(centery=screenrect.centery, right=pos.left)
-      self._surface.blit(self._batteryicon,pos)
+      self._battseg.text = self._batterycharge + txtcharge + '%'
     else:
-      pos = pygame.Rect(screenrect.right,0,0,screenrect.height)
-
-    # Draw memory utilisation
-    text = self._font.render(str(int(self._memory.percent)) + '%', 1, (10,10,10))
-    pos = text.get_rect(right = pos.left-self._headerspacing, centery=screenrect.centery)
-    self._surface.blit(text,pos)
-    pos = self._memicon.get_rect(centery=screenrect.centery, right=pos.left)
-    self._surface.blit(self._memicon,pos)
-
-    # Draw CPU utilisation
-    text = self._font.render(str(int(self._cpu)) + '%', 1, (10,10,10))
-    pos = text.get_rect(right = pos.left-self._headerspacing, centery=screenrect.centery)
-    self._surface.blit(text,pos)
-    pos = self._cpuicon.get_rect(centery=screenrect.centery, right=pos.left)
-    self._surface.blit(self._cpuicon,pos)
-    
-    text = self._font.render(self._networkip, 1, (10,10,10))
-    pos = text.get_rect(left=0, centery=screenrect.centery)
-    self._surface.blit(text,pos)
-
+      self._battseg.text = None
+    self._memseg.text = str(int(self._memory.percent)) + '%'
+    self._cpuseg.text = str(int(self._cpu)) + '%'
+    self._ipseg.text = self._networkip
     # Blink activity for debug purpose
     if self._blink_on:
-      text = self._font.render('*', 1, (10,10,10))
-      pos = text.get_rect(center=screenrect.center)
-      self._surface.blit(text,pos)
-        
+      self._activityseg.text = '*'
+    else:
+      self._activityseg.text = None
+
+  def _layout(self):
+    # Work out where each segment sits for its current text
+    screenrect = self._surface.get_rect()
+    # Battery, memory and CPU stack up from the right hand side
+    right = screenrect.right
+    for seg in (self._battseg, self._memseg, self._cpuseg):
+      if seg.text is None:
+        seg.rect = None
+        right = right - self._headerspacing
+        continue
+      text = TextCache.render(self._font, seg.text, 1, (10,10,10))
+      pos = text.get_rect(right=right, centery=screenrect.centery)
+      seg.rect = pos.union(seg.icon.get_rect(centery=screenrect.centery, right=pos.left))
+      right = seg.rect.left - self._headerspacing
+
+    text = TextCache.render(self._font, self._networkip, 1, (10,10,10))
+    self._ipseg.rect = text.get_rect(left=0, centery=screenrect.centery)
+
+    if self._activityseg.text is None:
+      self._activityseg.rect = None
+    else:
+      text = TextCache.render(self._font, self._activityseg.text, 1, (10,10,10))
+      self._activityseg.rect = text.get_rect(center=screenrect.center)
+
+  def _draw_segment(self, seg):
+    text = TextCache.render(self._font, seg.text, 1, (10,10,10))
+    if seg.icon:
+      self._surface.blit(seg.icon, seg.icon.get_rect(left=seg.rect.left, centery=seg.rect.centery))
+      self._surface.blit(text, text.get_rect(right=seg.rect.right, centery=seg.rect.centery))
+    else:
+      self._surface.blit(text, text.get_rect(center=seg.rect.center))
+
+  def update_segments(self, force=False):
+    'Draw segments which have changed and damage only their regions'
+    self._segment_text()
+    self._layout()
+
+    # Area above the dividing line which segments can draw into
+    area = self._surface.get_rect()
+    area.height = area.height - 1
+
+    changed = [seg for seg in self._segments if force or seg.changed]
+    if not changed:
+      return
+    cleared = []
+    for seg in changed:
+      for rect in (seg.drawnrect, seg.rect):
+        if rect:
+          cleared.append(area.clip(rect))
+    # Unchanged segments overlapping a cleared area are drawn again too
+    for seg in self._segments:
+      if seg not in changed and seg.rect and seg.rect.collidelist(cleared) >= 0:
+        changed.append(seg)
+
+    for rect in cleared:
+      self._surface.fill(self._background, rect)
+    for seg in changed:
+      if seg.rect:
+        self._draw_segment(seg)
+      seg.drawntext = seg.text
+      seg.drawnrect = seg.rect
+    for rect in cleared:
+      self.damage(rect)
+
+  def draw(self):
+    # Clear background of header
+    self._surface.fill(self._background)
+    screenrect = self._surface.get_rect()
     # Draw the dividing line between header and app body images
     pygame.draw.line(self._surface, (0,0,0),
                      (screenrect.left,screenrect.bottom-1),
                      (screenrect.right, screenrect.bottom-1), 1)
+    for seg in self._segments:
+      seg.drawnrect = None
+    self.update_segments(True)
+    self.damage()
     
-  def _battevent(self, msgid, context, message):
-    if context == BATT_CAPACITY:
-      self._batterycharge = message
-    elif context == BATT_STATUS:
-      self._batterystatus = message
+  def _battcapacityevent(self, msgid, context, message):
+    self._batterycharge = message
+    self.update_segments()
 
-    self.draw()
+  def _battstatusevent(self, msgid, context, message):
+    self._batterystatus = message
+    self.update_segments()
 
   def _networkevent(self,mid,context,message):
     self._networkip = message
 
-    self.draw()
+    self.update_segments()
     
 
 class SystemWindow(AppSubscriber, PygameWnd):
@@ -174,6 +248,14 @@ class SystemWindow(AppSubscriber, PygameWnd):
   def _touch(self, msgid, context, message):
     self.touch(message)
   
+  @property
+  def app_running(self):
+    return self._appwnd.app_running
+
+  def next_work_time(self):
+    'Time that do_work next has something to do, other than running apps'
+    return self._headerwnd.next_work_time()
+
   def do_work(self):
     # give timeslice to launcher window
     self._appwnd.work()
@@ -181,6 +263,5 @@ class SystemWindow(AppSubscriber, PygameWnd):
     # give timeslice to header window
     self._headerwnd.work()
 
-    self._headerwnd.copy_to(self)
-    self._appwnd.copy_to(self)
+    self.compose()
     
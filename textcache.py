@@ -0,0 +1,117 @@
+# Process wide cache of rendered text images. Status bar values, button
+# labels and app text mostly repeat between redraws so are only rendered once
+#
+# Copyright (C) 2019 Aidan Holmes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Email: aidanholmes@orbitalfruit.co.uk
+
+from collections import OrderedDict
+from threading import Lock
+
+class TextRenderCache(object):
+    DEFAULT_LIMIT = 1024*1024 # bytes
+    def __init__(self, limit=DEFAULT_LIMIT):
+        # Rendered images keyed by (font, text, antialias, colour, background).
+        # Font objects are created per face and size so the font in the
+        # key identifies both. Oldest used entries are at the front
+        self._images = OrderedDict()
+        self._limit = limit
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = Lock()
+
+    @property
+    def limit(self):
+        'maximum bytes of image data held in the cache'
+        return self._limit
+
+    @limit.setter
+    def limit(self, val):
+        self._lock.acquire()
+        try:
+            self._limit = val
+            self._evict()
+        finally:
+            self._lock.release()
+
+    @property
+    def size(self):
+        'bytes of image data currently held in the cache'
+        return self._size
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def __len__(self):
+        return len(self._images)
+
+    @staticmethod
+    def _image_size(img):
+        return img.get_pitch() * img.get_height()
+
+    def render(self, font, text, antialias, colour, background=None):
+        'Same as font.render but returns a shared image. Do not draw on the returned image'
+        key = (font, text, bool(antialias), tuple(colour),
+               None if background is None else tuple(background))
+        self._lock.acquire()
+        try:
+            img = self._images.get(key)
+            if img is not None:
+                self._hits += 1
+                self._images.move_to_end(key)
+                return img
+            self._misses += 1
+        finally:
+            self._lock.release()
+
+        if background is None:
+            img = font.render(text, antialias, colour)
+        else:
+            img = font.render(text, antialias, colour, background)
+
+        self._lock.acquire()
+        try:
+            if key not in self._images:
+                self._images[key] = img
+                self._size += self._image_size(img)
+                self._evict()
+        finally:
+            self._lock.release()
+        return img
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._images.clear()
+            self._size = 0
+            self._hits = 0
+            self._misses = 0
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        # Drop least recently used images until back under the limit
+        while self._size > self._limit and self._images:
+            key, img = self._images.popitem(last=False)
+            self._size -= self._image_size(img)
+
+TextCache = TextRenderCache()